@@ -1,20 +1,24 @@
 # setup.py
 import argparse
+import logging
 import threading
 import time
 import cv2
-from flask import Flask, jsonify
+from flask import Flask, request
 from ultralytics import YOLO
-
-# Scientific computing
-import numpy as np
 import os
 
 # Import from our other project files
 from video_processor import video_processing_thread
 import shared_state
+from utils import prefer_engine
 
 app = Flask(__name__)
+log = logging.getLogger(__name__)
+
+# The version counters restart at 0 with the process, so ETags carry the
+# start time too; a client's ETag from an earlier run can never match
+_ETAG_PREFIX = f"{time.time_ns():x}-"
 
 @app.route('/')
 def index():
@@ -22,20 +26,31 @@ def index():
 
 @app.route('/detections')
 def get_detections():
-    with shared_state.lock:
-        return jsonify(shared_state.detection_data)
+    # Pollers that already hold the current snapshot get an empty 304
+    if request.if_none_match.contains(f"{_ETAG_PREFIX}{shared_state.detection_version}"):
+        return '', 304
 
+    # Each detection_data snapshot is encoded once, on the first request that needs it
+    version, body = shared_state.get_detection_json()
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(f"{_ETAG_PREFIX}{version}")
+    return response
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Run a YOLO backend server.")
-    parser.add_argument(
-        '--mode', type=str, default='general', 
-        choices=['car_damage_yolo11m', 'general'],
-        help="The detection mode to use. 'car_damage_yolo11m' uses the local YOLO model."
-    )
-    parser.add_argument('--port', type=int, default=5002, help="Port to run the API server on.")
-    args = parser.parse_args()
+@app.route('/frame.jpg')
+def get_frame():
+    # Snapshot of the live feed; unchanged frames get an empty 304
+    if request.if_none_match.contains(f"{_ETAG_PREFIX}{shared_state.frame_version}"):
+        return '', 304
 
+    # Each frame is encoded once, on the first request that needs it
+    version, body = shared_state.get_frame_jpeg()
+    response = app.response_class(body, mimetype='image/jpeg')
+    response.set_etag(f"{_ETAG_PREFIX}{version}")
+    return response
+
+
+def run_server(args):
+    """Loads the model, starts the processing and Flask threads, and runs the live feed until 'q' is pressed."""
     # Always use local model processing
     MODEL_MAP = {
         'general': 'yolov8n.pt',
@@ -56,7 +71,8 @@ if __name__ == '__main__':
             exit(1)
 
     try:
-        model = YOLO(selected_model_file)
+        # Use an exported TensorRT engine (see utils.export_yolo_engine) when there is one
+        model = YOLO(prefer_engine(selected_model_file))
         print("Main thread: Model loaded successfully.")
     except Exception as e:
         print(f"ERROR: Failed to load model '{selected_model_file}': {e}")
@@ -65,7 +81,8 @@ if __name__ == '__main__':
     stop_event = threading.Event()
     
     # Start processing thread
-    processing_thread = threading.Thread(target=video_processing_thread, args=(args.mode, model), daemon=True)
+    processing_thread = threading.Thread(target=video_processing_thread, args=(args.mode, model),
+                                         kwargs={"stop": stop_event}, daemon=True)
     processing_thread.start()
 
     # Start Flask server thread
@@ -80,6 +97,12 @@ if __name__ == '__main__':
     cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
     cv2.resizeWindow(window_name, 1280, 720)
     cv2.moveWindow(window_name, 100, 100)  # Position the window
+    # Keep the window on top; setting this every frame costs a window-manager round trip
+    cv2.setWindowProperty(window_name, cv2.WND_PROP_TOPMOST, 1)
+
+    # Run display-side resizes through OpenCL (cv2.UMat) when a device is available
+    use_opencl = cv2.ocl.haveOpenCL()
+    cv2.ocl.setUseOpenCL(use_opencl)
     
     frames_displayed = 0
     last_display_time = time.time()
@@ -88,50 +111,38 @@ if __name__ == '__main__':
     while True:
         current_time = time.time()
         
-        # Get the latest frame with minimal lock time
+        # Grab the latest frame reference with minimal lock time. Producers
+        # publish a new buffer instead of drawing into the one being shown,
+        # so no copy is needed here.
         with shared_state.lock:
-            if shared_state.latest_annotated_frame is not None:
-                frame = shared_state.latest_annotated_frame.copy()
-            else:
-                frame = None
+            frame = shared_state.latest_annotated_frame
         
-        # Process and display the frame
-        if frame is not None and frame.size > 0:
-            try:
-                # Always resize to maintain consistent display
-                if frame.shape != (720, 1280, 3):
-                    frame = cv2.resize(frame, (1280, 720))
-                
-                # Create a copy for display
-                display_frame = frame.copy()
-                display_frame = np.ascontiguousarray(display_frame)
-                
-                # Force window to stay on top and show frame
-                cv2.setWindowProperty(window_name, cv2.WND_PROP_TOPMOST, 1)
-                cv2.imshow(window_name, display_frame)
-                frames_displayed += 1
-                last_frame = display_frame
-                
-                # Log display stats periodically
-                if current_time - last_display_time >= 2.0:
-                    fps = frames_displayed / (current_time - last_display_time)
-                    print(f"Display: Showing frames at {fps:.1f} FPS")
-                    frames_displayed = 0
-                    last_display_time = current_time
-            except Exception as e:
-                print(f"Display error: {e}")
-                # If we have a last good frame, try to keep showing it
-                if last_frame is not None:
-                    try:
-                        cv2.imshow(window_name, last_frame)
-                    except:
-                        pass
-        else:
-            # Show waiting screen
-            blank = np.zeros((720, 1280, 3), dtype=np.uint8)
-            cv2.putText(blank, "Waiting for frames...", (480, 360),
-                       cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-            cv2.imshow(window_name, blank)
+        # Process and display the frame. shared_state always holds a
+        # preallocated frame, so there is no empty/None case to handle.
+        try:
+            # Always resize to maintain consistent display
+            if frame.shape != (720, 1280, 3):
+                frame = cv2.resize(cv2.UMat(frame) if use_opencl else frame, (1280, 720))
+            
+            # Show the frame as-is; it is already contiguous
+            cv2.imshow(window_name, frame)
+            frames_displayed += 1
+            last_frame = frame
+            
+            # Log display stats periodically
+            if current_time - last_display_time >= 2.0:
+                fps = frames_displayed / (current_time - last_display_time)
+                log.debug("Display: Showing frames at %.1f FPS", fps)
+                frames_displayed = 0
+                last_display_time = current_time
+        except Exception as e:
+            print(f"Display error: {e}")
+            # If we have a last good frame, try to keep showing it
+            if last_frame is not None:
+                try:
+                    cv2.imshow(window_name, last_frame)
+                except:
+                    pass
         
         # Check for exit with a short wait time for smooth display
         key = cv2.waitKey(1) & 0xFF  # Shorter wait time for more responsive display
@@ -146,4 +157,16 @@ if __name__ == '__main__':
     
     # Give threads a moment to clean up
     time.sleep(1)
-    print("Main thread: Exiting.")
\ No newline at end of file
+    print("Main thread: Exiting.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a YOLO backend server.")
+    parser.add_argument(
+        '--mode', type=str, default='general', 
+        choices=['car_damage_yolo11m', 'general'],
+        help="The detection mode to use. 'car_damage_yolo11m' uses the local YOLO model."
+    )
+    parser.add_argument('--port', type=int, default=5002, help="Port to run the API server on.")
+    args = parser.parse_args()
+    run_server(args)
@@ -1,7 +1,44 @@
 # shared_state.py
+import json
 import threading
+import cv2
 import numpy as np
 
+try:  # Optional faster JSON encoder for the API payload
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # Optional libjpeg-turbo encoder for the frame snapshot
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+JPEG_QUALITY = 70  # Quality of the /frame.jpg snapshot
+
+
+def _encode(data):
+    """Encodes detection data to JSON bytes for the API."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=_to_builtin).encode('utf-8')
+
+
+def _encode_jpeg(frame):
+    """Encodes a BGR frame to JPEG bytes for the API."""
+    if simplejpeg is not None:
+        return simplejpeg.encode_jpeg(np.ascontiguousarray(frame), quality=JPEG_QUALITY, colorspace='BGR')
+    ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buf.tobytes() if ok else b''
+
+
+def _to_builtin(obj):
+    """json.dumps fallback for numpy arrays and scalars."""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
 # The lock to ensure thread-safe access.
 lock = threading.Lock()
 
@@ -14,7 +51,78 @@ detection_data = {
     },
     "dent_detections": []  # This will be a list of dictionaries for each dent
 }
+# Cached JSON encoding of detection_data; built lazily by get_detection_json().
+detection_json = None
+# Bumped on every update; served as the /detections ETag.
+detection_version = 0
 
 # This holds the latest frame for the live GUI feed.
 # Initialize with a blank frame to prevent errors on startup.
-latest_annotated_frame = np.zeros((720, 1280, 3), dtype=np.uint8)
\ No newline at end of file
+latest_annotated_frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+# Cached JPEG encoding of latest_annotated_frame; built lazily by get_frame_jpeg().
+latest_annotated_jpeg = None
+# Bumped on every published frame; served as the /frame.jpg ETag.
+frame_version = 0
+
+
+def publish_detections(**updates):
+    """
+    Publishes a new detection_data snapshot with `updates` applied. Snapshots
+    are never mutated after publishing, so readers can use
+    shared_state.detection_data without holding the lock.
+    """
+    global detection_data, detection_json, detection_version
+    data = {**detection_data, **updates}
+    with lock:
+        detection_data, detection_json = data, None
+        detection_version += 1
+
+
+def publish_frame(frame, **updates):
+    """
+    Publishes a new annotated frame. Frames are never mutated after
+    publishing, so readers can use latest_annotated_frame without copying.
+    Any `updates` are applied to detection_data (as publish_detections does)
+    in the same critical section.
+    """
+    global latest_annotated_frame, latest_annotated_jpeg, frame_version
+    global detection_data, detection_json, detection_version
+    data = {**detection_data, **updates} if updates else None
+    with lock:
+        latest_annotated_frame, latest_annotated_jpeg = frame, None
+        frame_version += 1
+        if data is not None:
+            detection_data, detection_json = data, None
+            detection_version += 1
+
+
+def get_frame_jpeg():
+    """
+    Returns (frame_version, JPEG bytes) for the latest frame, encoded at most
+    once per published frame however many clients fetch it.
+    """
+    global latest_annotated_jpeg
+    with lock:
+        frame, body, version = latest_annotated_frame, latest_annotated_jpeg, frame_version
+    if body is None:
+        body = _encode_jpeg(frame)
+        with lock:
+            if frame_version == version:
+                latest_annotated_jpeg = body
+    return version, body
+
+
+def get_detection_json():
+    """
+    Returns (detection_version, JSON bytes) for the current snapshot. Encoding
+    happens here, on the API thread, at most once per published snapshot.
+    """
+    global detection_json
+    with lock:
+        data, body, version = detection_data, detection_json, detection_version
+    if body is None:
+        body = _encode(data)
+        with lock:
+            if detection_data is data:
+                detection_json = body
+    return version, body
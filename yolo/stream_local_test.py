@@ -8,7 +8,7 @@ from ultralytics import YOLO
 from voxel_sdk.device_controller import DeviceController
 from voxel_sdk.ble import BleVoxelTransport
 
-from utils import _recv_exact, get_local_ip
+from utils import MAX_FRAME_LEN, _recv_exact, decode_jpeg, get_local_ip, prefer_engine
 
 # Configuration
 DEFAULT_MODEL = 'yolov8n.pt'
@@ -36,7 +36,8 @@ if __name__ == '__main__':
     # Select model
     model_file = select_model()
     print(f"Loading model from '{model_file}'...")
-    model = YOLO(model_file)
+    # Use an exported TensorRT engine (see utils.export_yolo_engine) when there is one
+    model = YOLO(prefer_engine(model_file))
     print("Model loaded.")
 
     # Connect to Voxel
@@ -69,8 +70,12 @@ if __name__ == '__main__':
         cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
         cv2.resizeWindow(WINDOW_NAME, 1280, 720)
 
+        # Reused for every frame; each payload is decoded before the next read
+        header_buf = bytearray(8)
+        payload_buf = bytearray(MAX_FRAME_LEN)
+
         while True:
-            header = _recv_exact(conn, 8)
+            header = _recv_exact(conn, 8, header_buf)
             if not header:
                 print("Stream closed or empty header. Exiting loop.")
                 break
@@ -79,12 +84,15 @@ if __name__ == '__main__':
                 break
 
             frame_len = struct.unpack('>I', header[4:])[0]
-            payload = _recv_exact(conn, frame_len)
+            if frame_len <= 0 or frame_len > MAX_FRAME_LEN:
+                print(f"Invalid frame length: {frame_len}")
+                break
+            payload = _recv_exact(conn, frame_len, payload_buf)
             if not payload:
                 print("Payload empty. Breaking.")
                 break
 
-            frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+            frame = decode_jpeg(payload)
             if frame is None:
                 print("Failed to decode frame")
                 continue
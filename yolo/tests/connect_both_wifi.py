@@ -13,10 +13,12 @@ This script prints JSON results from each device and a brief verdict per-method.
 """
 
 import argparse
+import asyncio
 import sys
 import os
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
@@ -31,27 +33,37 @@ BLE_NAME = 'voxel'
 CONNECT_TIMEOUT = 40  # seconds for connectWifi over serial/BLE
 
 
+def _connect_and_join_wifi(label, transport, connect_args, ssid, password):
+    """Connects one transport and issues connectWifi on it; returns (controller, device response)."""
+    transport.connect(*connect_args)
+    c = DeviceController(transport)
+    print(f'Sending connectWifi to {label}...')
+    return c, c.execute_device_command(f'connectWifi:{ssid}|{password}')
+
+
 def do_serial_serial(ssid, password):
     print('\n=== METHOD: serial + serial ===')
     results = {}
     transports = []
     controllers = []
     try:
-        for i, port in enumerate(SERIAL_PORTS[:2]):
-            print(f'Opening serial port {port} (device #{i+1})...')
-            t = SerialVoxelTransport(port, baudrate=115200, timeout=CONNECT_TIMEOUT)
-            t.connect()
-            c = DeviceController(t)
-            transports.append(t)
+        # The two devices are independent, so connect and issue connectWifi
+        # on both in parallel; the wait is the slower device, not the sum
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = {}
+            for i, port in enumerate(SERIAL_PORTS[:2]):
+                print(f'Opening serial port {port} (device #{i+1})...')
+                t = SerialVoxelTransport(port, baudrate=115200, timeout=CONNECT_TIMEOUT)
+                transports.append(t)
+                futures[f'serial_{i+1}'] = pool.submit(
+                    _connect_and_join_wifi, f'serial device #{i+1}', t, (), ssid, password)
+
+        # Collect in submission order so controllers[i] is device #i+1
+        for key, future in futures.items():
+            c, res = future.result()
             controllers.append(c)
-
-        # Issue connectWifi on both
-        for i, c in enumerate(controllers):
-            cmd = f'connectWifi:{ssid}|{password}'
-            print(f'Sending connectWifi to serial device #{i+1}...')
-            res = c.execute_device_command(cmd)
-            results[f'serial_{i+1}'] = res
-            print('  ->', res)
+            results[key] = res
+            print(f'  {key} ->', res)
 
     except Exception as e:
         print('Error during serial_serial:', e)
@@ -131,11 +143,7 @@ def do_ble_ble(ssid, password):
             return results
 
         print('Scanning for BLE devices... (10s)')
-        devices = BleakScanner.discover(timeout=6.0)
-        # In some bleak versions discover is coroutine; try to handle both
-        if hasattr(devices, '__await__'):
-            import asyncio
-            devices = asyncio.get_event_loop().run_until_complete(devices)
+        devices = asyncio.run(BleakScanner.discover(timeout=6.0))
 
         matches = [d for d in devices if (d.name or '').lower().startswith(BLE_NAME.lower())]
         print(f'Found {len(matches)} matches')
@@ -147,21 +155,24 @@ def do_ble_ble(ssid, password):
             results['found'] = len(matches)
             return results
 
-        # Connect to the two addresses
-        for i, dev in enumerate(matches[:2]):
-            addr = dev.address
-            print(f'Connecting BLE device #{i+1} at address {addr}...')
-            b = BleVoxelTransport(device_name=BLE_NAME)
-            b.connect(addr)
-            transports.append(b)
-            controllers.append(DeviceController(b))
-
-        # Issue connectWifi on both
-        for i, c in enumerate(controllers):
-            print(f'Sending connectWifi to BLE device #{i+1}...')
-            res = c.execute_device_command(f'connectWifi:{ssid}|{password}')
-            results[f'ble_{i+1}'] = res
-            print('  ->', res)
+        # Connect to the two addresses and issue connectWifi on both in
+        # parallel; each transport runs its own event loop thread
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = {}
+            for i, dev in enumerate(matches[:2]):
+                addr = dev.address
+                print(f'Connecting BLE device #{i+1} at address {addr}...')
+                b = BleVoxelTransport(device_name=BLE_NAME)
+                transports.append(b)
+                futures[f'ble_{i+1}'] = pool.submit(
+                    _connect_and_join_wifi, f'BLE device #{i+1}', b, (addr,), ssid, password)
+
+        # Collect in submission order so controllers[i] is device #i+1
+        for key, future in futures.items():
+            c, res = future.result()
+            controllers.append(c)
+            results[key] = res
+            print(f'  {key} ->', res)
 
     except Exception as e:
         print('Error during ble_ble:', e)
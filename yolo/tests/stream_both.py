@@ -11,158 +11,91 @@ The script will:
 4. Press 'q' to quit
 """
 
+import argparse
 import cv2
 import numpy as np
-import socket
-import struct
 import threading
-import time
-from typing import Optional, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+from stream_receiver import FRAME_HEIGHT, FRAME_WIDTH, StreamReceiver
 
 # Stream settings
 STREAM_PORTS = [9000, 9001]  # Left and right stream ports
 WINDOW_NAME = "Voxel Streams"
-FRAME_WIDTH = 640  # Each stream
-FRAME_HEIGHT = 480
 
-class StreamReceiver:
-    """Handles receiving and decoding frames from one MJPG stream."""
-    
-    def __init__(self, port: int):
-        self.port = port
-        self.latest_frame: Optional[np.ndarray] = None
-        self.latest_timestamp = 0.0
-        self.running = False
-        self.connected = False
-        self._lock = threading.Lock()
-    
-    def _recv_exact(self, sock: socket.socket, length: int) -> Optional[bytes]:
-        """Read exactly length bytes or return None if connection closed."""
-        chunks = []
-        remaining = length
-        while remaining > 0:
-            chunk = sock.recv(remaining)
-            if not chunk:
-                return None
-            chunks.append(chunk)
-            remaining -= len(chunk)
-        return b"".join(chunks)
-
-    def get_frame(self) -> Tuple[Optional[np.ndarray], float]:
-        """Get the latest frame and its timestamp. Thread-safe."""
-        with self._lock:
-            return self.latest_frame, self.latest_timestamp
-
-    def _update_frame(self, frame: Optional[np.ndarray]):
-        """Update the latest frame. Thread-safe."""
-        with self._lock:
-            self.latest_frame = frame
-            self.latest_timestamp = time.time()
-
-    def receive_frames(self):
-        """Main receive loop - runs in its own thread."""
-        while self.running:
-            try:
-                # Try to connect/reconnect
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(5.0)  # Timeout for connect and recv
-                sock.connect(('localhost', self.port))
-                self.connected = True
-                print(f"Connected to stream on port {self.port}")
-
-                while self.running:
-                    # Read 8-byte header
-                    header = self._recv_exact(sock, 8)
-                    if not header:
-                        print(f"Stream {self.port}: Connection closed")
-                        break
-
-                    # Verify magic and get length
-                    if header[:4] != b"VXL0":
-                        print(f"Stream {self.port}: Invalid magic in header")
-                        break
-
-                    frame_len = struct.unpack(">I", header[4:])[0]
-                    if frame_len <= 0 or frame_len > 5 * 1024 * 1024:
-                        print(f"Stream {self.port}: Invalid frame length {frame_len}")
-                        break
-
-                    # Read and decode the JPEG frame
-                    jpeg_data = self._recv_exact(sock, frame_len)
-                    if not jpeg_data:
-                        print(f"Stream {self.port}: Failed reading frame data")
-                        break
-
-                    frame_array = np.frombuffer(jpeg_data, dtype=np.uint8)
-                    frame = cv2.imdecode(frame_array, cv2.IMREAD_COLOR)
-                    if frame is not None:
-                        # Resize to target size
-                        frame = cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT))
-                        self._update_frame(frame)
-
-            except (socket.error, ConnectionError) as e:
-                print(f"Stream {self.port}: Connection error: {e}")
-                self.connected = False
-                if self.running:
-                    time.sleep(1.0)  # Wait before retry
-                continue
-
-            finally:
-                try:
-                    sock.close()
-                except Exception:
-                    pass
-
-    def start(self):
-        """Start the receiver thread."""
-        self.running = True
-        threading.Thread(target=self.receive_frames, daemon=True).start()
-
-    def stop(self):
-        """Stop the receiver thread."""
-        self.running = False
+
+def _render_label(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Renders a frame label once; returns its pixels and a mask of the drawn text."""
+    (w, _), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.8, 2)
+    pixels = np.zeros((30 + baseline + 2, 10 + w + 2, 3), dtype=np.uint8)
+    cv2.putText(pixels, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+    return pixels, pixels.any(axis=2)
+
+
+def _render_waiting(port: int, connected: bool) -> np.ndarray:
+    """Renders the full placeholder shown until a stream delivers its first frame."""
+    screen = np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+    text = f"Waiting for stream {port}..."
+    if connected:
+        text += " (Connected)"
+    cv2.putText(screen, text, (40, FRAME_HEIGHT//2),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+    return screen
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu-decode', action='store_true',
+                        help='Decode frames on the GPU with nvJPEG (needs torch, torchvision and CUDA)')
+    args = parser.parse_args()
+
     # Create window
     cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
     
+    # Display buffer, only touched by this thread; frames are copied
+    # into its halves when composing
+    display = np.zeros((FRAME_HEIGHT, 2 * FRAME_WIDTH, 3), dtype=np.uint8)
+    halves = [display[:, :FRAME_WIDTH], display[:, FRAME_WIDTH:]]
+
     # Start receivers
-    receivers = [StreamReceiver(port) for port in STREAM_PORTS]
+    new_frame = threading.Event()
+    # Shared decode pool so a burst on one stream can use every worker
+    decode_pool = ThreadPoolExecutor(max_workers=4)
+    receivers = [StreamReceiver(port, gpu_decode=args.gpu_decode, new_frame_event=new_frame,
+                                decode_pool=decode_pool)
+                 for port in STREAM_PORTS]
     for r in receivers:
         r.start()
+    new_frame.set()  # Draw the waiting screen right away
+
+    # Text rendering is the slow part of labelling, so draw the constant
+    # labels and placeholders once and only blit them per frame
+    labels = [_render_label(f"Port {port}") for port in STREAM_PORTS]
+    waiting = [(_render_waiting(port, False), _render_waiting(port, True))
+               for port in STREAM_PORTS]
 
     try:
-        blank = np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
         while True:
-            # Get latest frames
-            frames = []
-            for i, receiver in enumerate(receivers):
-                frame, ts = receiver.get_frame()
-                if frame is None:
-                    # If no frame, show info text on blank
-                    info = blank.copy()
-                    text = f"Waiting for stream {STREAM_PORTS[i]}..."
-                    if receiver.connected:
-                        text += " (Connected)"
-                    cv2.putText(info, text,
-                              (40, FRAME_HEIGHT//2),
-                              cv2.FONT_HERSHEY_SIMPLEX, 0.8,
-                              (255, 255, 255), 2)
-                    frames.append(info)
-                else:
-                    # Add port number to frame
-                    labeled = frame.copy()
-                    cv2.putText(labeled, f"Port {STREAM_PORTS[i]}",
-                              (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
-                              0.8, (0, 255, 0), 2)
-                    frames.append(labeled)
-
-            # Combine side by side
-            if len(frames) == 2:
-                display = np.hstack(frames)
+            # Recomposite only when a receiver has something new; otherwise
+            # just wait (up to one frame time) and keep the window responsive
+            if new_frame.wait(timeout=0.033):
+                new_frame.clear()
+
+                # Copy each receiver's latest frame into its half and label it
+                for i, receiver in enumerate(receivers):
+                    half = halves[i]
+                    if not receiver.copy_frame_into(half):
+                        # If no frame, show info text on blank
+                        np.copyto(half, waiting[i][receiver.connected])
+                    else:
+                        # Add port number to frame
+                        pixels, mask = labels[i]
+                        roi = half[:mask.shape[0], :mask.shape[1]]
+                        roi[mask] = pixels[mask]
+
                 cv2.imshow(WINDOW_NAME, display)
-            
+
             # Check for quit
             key = cv2.waitKey(1)
             if key == ord('q') or key == 27:  # q or ESC
@@ -172,6 +105,7 @@ def main():
         # Clean up
         for r in receivers:
             r.stop()
+        decode_pool.shutdown(wait=False)
         cv2.destroyAllWindows()
 
 
@@ -9,19 +9,19 @@ This script:
 5. Press 'q' to quit
 
 Usage:
-    python3 yolo/tests/stream_both_init.py --ssid YOUR_SSID --password YOUR_PASS
+    python3 yolo/tests/stream_both_init.py --ssid YOUR_SSID --password YOUR_PASS [--gpu-decode]
 """
 
 import sys
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 import threading
 import cv2
 import numpy as np
 import socket
-import struct
 import argparse
-from typing import Optional, Dict, Tuple, List
+from typing import Tuple, List
 
 # Add parent dir to path so we can import voxel_sdk
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -29,6 +29,9 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 from voxel_sdk.serial import SerialVoxelTransport
 from voxel_sdk.ble import BleVoxelTransport
 from voxel_sdk.device_controller import DeviceController
+from stream_receiver import FRAME_HEIGHT, FRAME_WIDTH, StreamReceiver
+from stream_utils import (STREAM_RETRY_DELAY, STREAM_RETRY_MAX_DELAY, STREAM_STOP_SETTLE,
+                          get_network_info, wait_for_wifi, wifi_on_network)
 
 # Device settings
 SERIAL_PORT = '/dev/cu.usbmodem101'
@@ -37,105 +40,6 @@ BLE_NAME = 'voxel'
 # Stream settings
 STREAM_PORTS = [9000, 9001]  # Left and right stream ports
 WINDOW_NAME = "Voxel Streams"
-FRAME_WIDTH = 640  # Each stream
-FRAME_HEIGHT = 480
-
-class StreamReceiver:
-    """Handles receiving and decoding frames from one MJPG stream."""
-    
-    def __init__(self, port: int):
-        self.port = port
-        self.latest_frame: Optional[np.ndarray] = None
-        self.latest_timestamp = 0.0
-        self.running = False
-        self.connected = False
-        self._lock = threading.Lock()
-    
-    def _recv_exact(self, sock: socket.socket, length: int) -> Optional[bytes]:
-        """Read exactly length bytes or return None if connection closed."""
-        chunks = []
-        remaining = length
-        while remaining > 0:
-            chunk = sock.recv(remaining)
-            if not chunk:
-                return None
-            chunks.append(chunk)
-            remaining -= len(chunk)
-        return b"".join(chunks)
-
-    def get_frame(self) -> Tuple[Optional[np.ndarray], float]:
-        """Get the latest frame and its timestamp. Thread-safe."""
-        with self._lock:
-            return self.latest_frame, self.latest_timestamp
-
-    def _update_frame(self, frame: Optional[np.ndarray]):
-        """Update the latest frame. Thread-safe."""
-        with self._lock:
-            self.latest_frame = frame
-            self.latest_timestamp = time.time()
-
-    def receive_frames(self):
-        """Main receive loop - runs in its own thread."""
-        while self.running:
-            try:
-                # Try to connect/reconnect
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(5.0)  # Timeout for connect and recv
-                sock.connect(('localhost', self.port))
-                self.connected = True
-                print(f"Connected to stream on port {self.port}")
-
-                while self.running:
-                    # Read 8-byte header
-                    header = self._recv_exact(sock, 8)
-                    if not header:
-                        print(f"Stream {self.port}: Connection closed")
-                        break
-
-                    # Verify magic and get length
-                    if header[:4] != b"VXL0":
-                        print(f"Stream {self.port}: Invalid magic in header")
-                        break
-
-                    frame_len = struct.unpack(">I", header[4:])[0]
-                    if frame_len <= 0 or frame_len > 5 * 1024 * 1024:
-                        print(f"Stream {self.port}: Invalid frame length {frame_len}")
-                        break
-
-                    # Read and decode the JPEG frame
-                    jpeg_data = self._recv_exact(sock, frame_len)
-                    if not jpeg_data:
-                        print(f"Stream {self.port}: Failed reading frame data")
-                        break
-
-                    frame_array = np.frombuffer(jpeg_data, dtype=np.uint8)
-                    frame = cv2.imdecode(frame_array, cv2.IMREAD_COLOR)
-                    if frame is not None:
-                        # Resize to target size
-                        frame = cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT))
-                        self._update_frame(frame)
-
-            except (socket.error, ConnectionError) as e:
-                print(f"Stream {self.port}: Connection error: {e}")
-                self.connected = False
-                if self.running:
-                    time.sleep(1.0)  # Wait before retry
-                continue
-
-            finally:
-                try:
-                    sock.close()
-                except Exception:
-                    pass
-
-    def start(self):
-        """Start the receiver thread."""
-        self.running = True
-        threading.Thread(target=self.receive_frames, daemon=True).start()
-
-    def stop(self):
-        """Stop the receiver thread."""
-        self.running = False
 
 
 def connect_wifi(controllers: List[DeviceController], ssid: str, password: str) -> bool:
@@ -155,6 +59,15 @@ def connect_wifi(controllers: List[DeviceController], ssid: str, password: str)
             
         for i, ctrl in enumerate(controllers):
             print(f"\nConnecting device #{i+1} to WiFi...")
+
+            # Skip the disconnect/reconnect if the device is already on the network
+            try:
+                status = ctrl.execute_device_command('wifi_client_status')
+            except Exception:
+                status = None
+            if wifi_on_network(status, ssid):
+                print(f"Device #{i+1} already on {ssid} with IP {status.get('ip')}")
+                continue
             
             # First try disconnecting to clear any stale connections
             try:
@@ -181,10 +94,9 @@ def connect_wifi(controllers: List[DeviceController], ssid: str, password: str)
                         if host_parts[:2] != dev_parts[:2]:
                             print(f"Warning: Device #{i+1} ({dev_ip}) appears to be on different subnet than host ({host_ip})")
             
-            time.sleep(3)  # Give WiFi more time to establish
-            
-            # Verify connection with status check
-            status = ctrl.execute_device_command('wifi_client_status')
+            # Verify connection, polling until the link is up rather than
+            # always sleeping for the worst case
+            status = wait_for_wifi(ctrl, ssid)
             print(f"WiFi status:", status)
             if isinstance(status, dict) and status.get('error'):
                 print(f"Device #{i+1} WiFi status check failed")
@@ -196,34 +108,84 @@ def connect_wifi(controllers: List[DeviceController], ssid: str, password: str)
         return False
 
 
-def get_network_info() -> dict:
-    """Get network information including host IP and gateway."""
-    info = {'host_ip': None, 'gateway': None}
+def connect_devices(ssid: str, password: str) -> List[DeviceController]:
+    """Connect to the serial device, then the BLE one, and put both on WiFi."""
+    controllers = []
+    try:
+        print(f"Connecting to serial device on {SERIAL_PORT}...")
+        serial_transport = SerialVoxelTransport(SERIAL_PORT, baudrate=115200)
+        serial_transport.connect()
+        controllers.append(DeviceController(serial_transport))
+
+        print(f"Connecting to BLE device '{BLE_NAME}'...")
+        ble_transport = BleVoxelTransport(device_name=BLE_NAME)
+        ble_transport.connect("")
+        controllers.append(DeviceController(ble_transport))
+
+        if not connect_wifi(controllers, ssid, password):
+            raise RuntimeError("Failed to connect both devices to WiFi")
+        return controllers
+    except BaseException:
+        for c in controllers:
+            try:
+                c.disconnect()
+            except Exception:
+                pass
+        raise
+
+
+def _start_one(i: int, ctrl: DeviceController, net_info: dict) -> bool:
+    """Start the stream on device #i+1, probing target IPs until one works."""
+    port = STREAM_PORTS[i]
+    print(f"\nStarting stream on device #{i+1} (port {port})...")
     
+    # Try rdmp_stop first in case there's a stale stream
     try:
-        # Get host IP
-        temp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        temp_sock.connect(("8.8.8.8", 80))
-        info['host_ip'] = temp_sock.getsockname()[0]
-        temp_sock.close()
+        ctrl.execute_device_command('rdmp_stop')
+        time.sleep(STREAM_STOP_SETTLE)
+    except Exception:
+        pass
         
-        # Try to get gateway
-        import subprocess
-        if sys.platform == "darwin":  # macOS
-            try:
-                result = subprocess.run(['netstat', '-nr'], capture_output=True, text=True)
-                for line in result.stdout.split('\n'):
-                    if 'default' in line:
-                        parts = line.split()
-                        if len(parts) > 1:
-                            info['gateway'] = parts[1]
-                            break
-            except Exception as e:
-                print(f"Warning: Could not determine gateway: {e}")
-    except Exception as e:
-        print(f"Warning: Could not determine network info: {e}")
+    # Try IPs in order of likelihood to work
+    ips_to_try = []
+    if net_info['host_ip']:
+        ips_to_try.append(net_info['host_ip'])
+    if net_info['gateway']:
+        ips_to_try.append(net_info['gateway'])
+    ips_to_try.extend(["172.20.10.10", "172.20.10.1", ""])  # Previous working IPs + empty
     
-    return info
+    # Back off exponentially between attempts so a quick success is not
+    # held up by a fixed pause
+    delay = STREAM_RETRY_DELAY
+    for ip in ips_to_try:
+        if not ip:
+            print("Trying default IP (empty string)...")
+        else:
+            print(f"Trying IP: {ip}")
+            
+        try:
+            res = ctrl.execute_device_command(f'rdmp_stream:{ip}|{port}')
+            print(f"Stream result:", res)
+            
+            if i == 0:  # Serial device
+                raw = str(res.get('raw_response', '')).lower() if isinstance(res, dict) else ''
+                if not raw or 'camera' in raw:
+                    print("Serial device appears to be starting stream...")
+                    return True
+            else:  # BLE device
+                if not (isinstance(res, dict) and res.get('error')):
+                    return True
+                if 'Failed to connect to remote host' not in str(res.get('error', '')):
+                    print("BLE device error - stopping attempts")
+                    break
+        except Exception as e:
+            print(f"Error with IP {ip}: {e}")
+        
+        time.sleep(delay)
+        delay = min(delay * 2, STREAM_RETRY_MAX_DELAY)
+    
+    print(f"Failed to start stream on device #{i+1}")
+    return False
 
 def start_streams(controllers: List[DeviceController]) -> bool:
     """Start streams on both devices. Return True if both started successfully."""
@@ -232,58 +194,12 @@ def start_streams(controllers: List[DeviceController]) -> bool:
         net_info = get_network_info()
         print(f"\nNetwork info: {net_info}")
         
-        # Start streams on both devices
-        for i, ctrl in enumerate(controllers):
-            port = STREAM_PORTS[i]
-            print(f"\nStarting stream on device #{i+1} (port {port})...")
-            
-            # Try rdmp_stop first in case there's a stale stream
-            try:
-                ctrl.execute_device_command('rdmp_stop')
-                time.sleep(0.5)
-            except Exception:
-                pass
-                
-            # Try IPs in order of likelihood to work
-            ips_to_try = []
-            if net_info['host_ip']:
-                ips_to_try.append(net_info['host_ip'])
-            if net_info['gateway']:
-                ips_to_try.append(net_info['gateway'])
-            ips_to_try.extend(["172.20.10.10", "172.20.10.1", ""])  # Previous working IPs + empty
-            
-            success = False
-            for ip in ips_to_try:
-                if not ip:
-                    print("Trying default IP (empty string)...")
-                else:
-                    print(f"Trying IP: {ip}")
-                    
-                try:
-                    res = ctrl.execute_device_command(f'rdmp_stream:{ip}|{port}')
-                    print(f"Stream result:", res)
-                    
-                    if i == 0:  # Serial device
-                        raw = str(res.get('raw_response', '')).lower() if isinstance(res, dict) else ''
-                        if not raw or 'camera' in raw:
-                            print("Serial device appears to be starting stream...")
-                            success = True
-                            break
-                    else:  # BLE device
-                        if not (isinstance(res, dict) and res.get('error')):
-                            success = True
-                            break
-                        if 'Failed to connect to remote host' not in str(res.get('error', '')):
-                            print("BLE device error - stopping attempts")
-                            break
-                except Exception as e:
-                    print(f"Error with IP {ip}: {e}")
-                
-                time.sleep(0.5)
-            
-            if not success:
-                print(f"Failed to start stream on device #{i+1}")
-                return False
+        # The devices have separate transports, so probe both at once; the
+        # wait is the slower device rather than the sum of both
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            results = list(ex.map(lambda ic: _start_one(*ic, net_info), enumerate(controllers)))
+        if not all(results):
+            return False
         
         print("\nStreams started - waiting 2s for sockets to open...")
         time.sleep(2)
@@ -292,155 +208,33 @@ def start_streams(controllers: List[DeviceController]) -> bool:
     except Exception as e:
         print(f"Error starting streams: {e}")
         return False
-            host_ip = None
-            try:
-                # Try to get IP by connecting to a public DNS
-                temp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                temp_sock.connect(("8.8.8.8", 80))
-                host_ip = temp_sock.getsockname()[0]
-                temp_sock.close()
-            except Exception:
-                # Fallback: try hostname lookup
-                for ip in socket.gethostbyname_ex(socket.gethostname())[2]:
-                    if not ip.startswith("127."):
-                        host_ip = ip
-                        break
-                        
-            # Try a few common options for host IP:
-            host_ips = ["172.20.10.10", "172.20.10.1", host_ip, ""]  # Previous IP, gateway, detected, default
-            
-            success = False
-            for try_ip in [ip for ip in host_ips if ip]:  # Filter out empty
-                print(f"Trying host IP {try_ip} for stream target...")
-                
-                try:
-                    res = ctrl.execute_device_command(f'rdmp_stream:{try_ip}|{port}')
-                    print(f"Stream result (port {port}):", res)
-                    
-                    if i == 0:  # Serial device
-                        raw = str(res.get('raw_response', '')).lower() if isinstance(res, dict) else ''
-                        if not raw or 'camera' in raw:  # Accept empty or camera-related messages
-                            print("Serial device appears to be starting stream...")
-                            success = True
-                            break
-                    else:  # BLE device
-                        if not (isinstance(res, dict) and res.get('error')):
-                            success = True
-                            break
-                        if res.get('error') and 'Failed to connect to remote host' not in str(res['error']):
-                            print("BLE device error - stopping attempts")
-                            break
-                            
-                except Exception as e:
-                    print(f"Error with IP {try_ip}: {e}")
-                
-                time.sleep(0.5)  # Brief pause between attempts
-            
-            if not success:
-                print(f"Failed to start stream on device #{i+1}")
-                return False
-                
-        print("\nStreams started - waiting 2s for sockets to open...")
-        time.sleep(2)
-        return True
-
-    except Exception as e:
-        print(f"Error starting streams: {e}")
-        return False
-            
-            if not success:
-                print(f"Failed to start stream on device #{i+1}")
-                return False
 
-        print("\nStreams started - waiting 2s for sockets to open...")
-        time.sleep(2)
-        return True
 
-    except Exception as e:
-        print(f"Error starting streams: {e}")
-        return False
-            
-            # Try a few common options for host IP:
-            host_ips = [
-                "172.20.10.10",  # Your IP from earlier
-                "172.20.10.1",   # Gateway from BLE device
-                host_ip,         # Detected IP
-                "",             # Let device use default
-            ]
-            
-            success = False
-            for try_ip in [ip for ip in host_ips if ip]:  # Filter out empty
-                print(f"Trying host IP {try_ip} for stream target...")
-                res = ctrl.execute_device_command(f'rdmp_stream:{try_ip}|{port}')
-                print(f"Stream result (port {port}):", res)
-                
-                if i == 0:  # Serial device
-                    if isinstance(res, dict):
-                        raw = str(res.get('raw_response', '')).lower()
-                        if not raw or 'camera' in raw:  # Accept empty or camera-related messages
-                            print("Serial device appears to be starting stream...")
-                            success = True
-                            break
-                        elif not res.get('error'):
-                            success = True
-                            break
-                else:  # BLE device
-                    if not (isinstance(res, dict) and res.get('error')):
-                        success = True
-                        break
-                    elif 'Failed to connect to remote host' in str(res.get('error', '')):
-                        print("Network error - trying next IP...")
-                        # Continue to next IP
-                    else:
-                        print("BLE device error - stopping attempts")
-                        break
-                
-                time.sleep(0.5)  # Brief pause between attempts
-            
-            if not success:
-                print(f"Failed to start stream on device #{i+1}")
-                return False
+def _render_label(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Renders a frame label once; returns its pixels and a mask of the drawn text."""
+    (w, _), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.8, 2)
+    pixels = np.zeros((30 + baseline + 2, 10 + w + 2, 3), dtype=np.uint8)
+    cv2.putText(pixels, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+    return pixels, pixels.any(axis=2)
 
-        print("\nStreams started - waiting 2s for sockets to open...")
-        time.sleep(2)
-        return True
 
-    except Exception as e:
-        print(f"Error starting streams: {e}")
-        return False
-            
-            # For serial device (first one), accept any non-error or camera-init message
-            if i == 0:  # Serial
-                if isinstance(res, dict):
-                    if res.get('error'):
-                        raw = str(res.get('raw_response', '')).lower()
-                        if not raw or 'camera' in raw:  # Accept empty or camera-related messages
-                            print("Serial device appears to be starting stream...")
-                            time.sleep(1)  # Give it a moment
-                            continue
-                    elif not res.get('error'):
-                        continue
-                    # Other errors - fail
-                    return False
-            else:  # BLE - require success
-                if isinstance(res, dict) and res.get('error'):
-                    if 'Failed to connect to remote host' in str(res.get('error', '')):
-                        print("Network error - check if host IP is reachable")
-                    return False
-
-        print("\nStreams started - waiting 2s for sockets to open...")
-        time.sleep(2)
-        return True
-
-    except Exception as e:
-        print(f"Error starting streams: {e}")
-        return False
+def _render_waiting(port: int, connected: bool) -> np.ndarray:
+    """Renders the full placeholder shown until a stream delivers its first frame."""
+    screen = np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+    text = f"Waiting for stream {port}..."
+    if connected:
+        text += " (Connected)"
+    cv2.putText(screen, text, (40, FRAME_HEIGHT//2),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+    return screen
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--ssid', required=True, help='WiFi SSID')
     parser.add_argument('--password', required=True, help='WiFi password')
+    parser.add_argument('--gpu-decode', action='store_true',
+                        help='Decode frames on the GPU with nvJPEG (needs torch, torchvision and CUDA)')
     args = parser.parse_args()
 
     controllers = None
@@ -460,46 +254,49 @@ def main():
         cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
         cv2.moveWindow(WINDOW_NAME, 100, 100)
         
+        # Display buffer, only touched by this thread; frames are copied
+        # into its halves when composing
+        display = np.zeros((FRAME_HEIGHT, 2 * FRAME_WIDTH, 3), dtype=np.uint8)
+        halves = [display[:, :FRAME_WIDTH], display[:, FRAME_WIDTH:]]
+
         # Start receivers
-        receivers = [StreamReceiver(port) for port in STREAM_PORTS]
+        new_frame = threading.Event()
+        # Shared decode pool so a burst on one stream can use every worker
+        decode_pool = ThreadPoolExecutor(max_workers=4)
+        receivers = [StreamReceiver(port, gpu_decode=args.gpu_decode, new_frame_event=new_frame,
+                                    decode_pool=decode_pool)
+                     for port in STREAM_PORTS]
         for r in receivers:
             r.start()
+        new_frame.set()  # Draw the waiting screen right away
+
+        # Text rendering is the slow part of labelling, so draw the constant
+        # labels and placeholders once and only blit them per frame
+        labels = [_render_label(f"Port {port} ({kind})")
+                  for port, kind in zip(STREAM_PORTS, ("Serial", "BLE"))]
+        waiting = [(_render_waiting(port, False), _render_waiting(port, True))
+                   for port in STREAM_PORTS]
 
-        blank = np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
         while True:
-            # Get latest frames
-            frames = []
-            for i, receiver in enumerate(receivers):
-                frame, ts = receiver.get_frame()
-                if frame is None:
-                    # If no frame, show info text on blank
-                    info = blank.copy()
-                    text = f"Waiting for stream {STREAM_PORTS[i]}..."
-                    if receiver.connected:
-                        text += " (Connected)"
-                    cv2.putText(info, text,
-                              (40, FRAME_HEIGHT//2),
-                              cv2.FONT_HERSHEY_SIMPLEX, 0.8,
-                              (255, 255, 255), 2)
-                    frames.append(info)
-                else:
-                    # Add port number to frame
-                    labeled = frame.copy()
-                    port_text = f"Port {STREAM_PORTS[i]}"
-                    if i == 0:
-                        port_text += " (Serial)"
+            # Recomposite only when a receiver has something new; otherwise
+            # just wait (up to one frame time) and keep the window responsive
+            if new_frame.wait(timeout=0.033):
+                new_frame.clear()
+
+                # Copy each receiver's latest frame into its half and label it
+                for i, receiver in enumerate(receivers):
+                    half = halves[i]
+                    if not receiver.copy_frame_into(half):
+                        # If no frame, show info text on blank
+                        np.copyto(half, waiting[i][receiver.connected])
                     else:
-                        port_text += " (BLE)"
-                    cv2.putText(labeled, port_text,
-                              (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
-                              0.8, (0, 255, 0), 2)
-                    frames.append(labeled)
-
-            # Combine side by side
-            if len(frames) == 2:
-                display = np.hstack(frames)
+                        # Add port number to frame
+                        pixels, mask = labels[i]
+                        roi = half[:mask.shape[0], :mask.shape[1]]
+                        roi[mask] = pixels[mask]
+
                 cv2.imshow(WINDOW_NAME, display)
-            
+
             # Check for quit
             key = cv2.waitKey(1)
             if key == ord('q') or key == 27:  # q or ESC
@@ -518,6 +315,7 @@ def main():
         if 'receivers' in locals():
             for r in receivers:
                 r.stop()
+            decode_pool.shutdown(wait=False)
         cv2.destroyAllWindows()
 
         # Stop streams and disconnect
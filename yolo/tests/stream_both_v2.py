@@ -22,10 +22,12 @@ import argparse
 from typing import List, Optional, Tuple
 from urllib.request import urlopen
 import socket
+from concurrent.futures import ThreadPoolExecutor
 
 from voxel_sdk import DeviceController
 from stream_utils import (
     connect_devices,
+    get_network_info,
     setup_wifi,
     start_device_stream,
     cleanup_devices
@@ -35,6 +37,9 @@ from stream_utils import (
 STREAM_PORTS = [9000, 9001]  # Ports for serial and BLE devices
 WINDOW_WIDTH = 640  # Target width for each stream window
 WINDOW_HEIGHT = 480  # Target height for each stream window
+# Run the display's resize/label/concat as OpenCL kernels (cv2.UMat) when a
+# device is available, leaving the CPU to the receive and decode threads
+USE_OPENCL = cv2.ocl.haveOpenCL()
 
 class StreamReceiver(threading.Thread):
     """Thread class for receiving and displaying MJPG stream."""
@@ -44,15 +49,14 @@ class StreamReceiver(threading.Thread):
         self.port = port
         self.device_num = device_num
         self.stream_url = f'http://localhost:{port}'
-        self.frame = None
+        self.frame = None  # Replaced, never mutated, so reads need no lock
         self.running = True
         self.connected = False
-        self.lock = threading.Lock()
     
     def get_frame(self) -> Optional[np.ndarray]:
         """Get the latest frame (thread-safe)."""
-        with self.lock:
-            return self.frame.copy() if self.frame is not None else None
+        frame = self.frame
+        return frame.copy() if frame is not None else None
     
     def stop(self):
         """Stop the receiver thread."""
@@ -71,19 +75,44 @@ class StreamReceiver(threading.Thread):
                 self.connected = True
                 print(f"Connected to stream #{self.device_num+1}")
                 
-                # Read stream
-                bytes_data = b''
+                # Read stream into a growable buffer. scan_pos marks how far it
+                # has already been searched for an end marker, so each byte is
+                # scanned once instead of on every read.
+                buf = bytearray()
+                scan_pos = 0
                 while self.running:
-                    bytes_data += stream.read(1024)
-                    a = bytes_data.find(b'\xff\xd8')  # JPEG start
-                    b = bytes_data.find(b'\xff\xd9')  # JPEG end
-                    if a != -1 and b != -1:
-                        jpg = bytes_data[a:b+2]
-                        bytes_data = bytes_data[b+2:]
-                        # Decode and store frame (thread-safe)
-                        img = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
-                        with self.lock:
-                            self.frame = img
+                    # read1 returns whatever is available (up to 64 KB) without
+                    # waiting for the full amount
+                    chunk = stream.read1(65536)
+                    if not chunk:
+                        raise ConnectionError("Stream closed")
+                    buf.extend(chunk)
+
+                    # Find the last complete JPEG in the buffer; older ones are
+                    # stale. Only offsets are tracked, nothing is copied out.
+                    consumed = 0
+                    jpg_start = jpg_end = -1
+                    while True:
+                        b = buf.find(b'\xff\xd9', max(scan_pos - 1, consumed))  # JPEG end
+                        if b == -1:
+                            scan_pos = len(buf)
+                            break
+                        a = buf.find(b'\xff\xd8', consumed, b)  # JPEG start
+                        if a != -1:
+                            jpg_start, jpg_end = a, b + 2
+                        consumed = scan_pos = b + 2
+
+                    if jpg_start != -1:
+                        # Decode straight out of the buffer and publish frame
+                        # (a single atomic attribute store)
+                        jpg = np.frombuffer(buf, np.uint8, jpg_end - jpg_start, jpg_start)
+                        self.frame = cv2.imdecode(jpg, cv2.IMREAD_COLOR)
+                        del jpg  # The view must go before the buffer is resized
+
+                    # Compact once per read, dropping everything already parsed
+                    if consumed:
+                        del buf[:consumed]
+                        scan_pos -= consumed
                 
             except Exception as e:
                 print(f"Stream #{self.device_num+1} error: {e}")
@@ -95,6 +124,13 @@ class StreamReceiver(threading.Thread):
                     print(f"Failed to connect to stream #{self.device_num+1} after {max_retries} attempts")
                     break
 
+def render_label(text: str, color: Tuple[int, int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Render a frame label once; returns its pixels and a mask of the drawn text."""
+    (w, _), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 1, 2)
+    pixels = np.zeros((30 + baseline + 2, 10 + w + 2, 3), np.uint8)
+    cv2.putText(pixels, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
+    return pixels, pixels.any(axis=2)
+
 def main(args):
     """Main entry point for the streaming script."""
     if not args.ssid or not args.password:
@@ -115,13 +151,16 @@ def main(args):
             cleanup_devices(controllers)
             return
             
-        # Start streams
+        # Start streams; the devices are independent, so probe both at once
         print("\nStarting streams...")
-        for i, ctrl in enumerate(controllers):
-            if not start_device_stream(ctrl, STREAM_PORTS[i], i):
-                print("Failed to start streams")
-                cleanup_devices(controllers)
-                return
+        net_info = get_network_info()
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            started = list(ex.map(lambda ic: start_device_stream(ic[1], STREAM_PORTS[ic[0]], ic[0], net_info),
+                                  enumerate(controllers)))
+        if not all(started):
+            print("Failed to start streams")
+            cleanup_devices(controllers)
+            return
         
         # Create stream receivers
         receivers = [
@@ -140,11 +179,34 @@ def main(args):
         # Display loop
         print("\nStarting display... Press 'q' to quit")
         cv2.namedWindow('Voxel Streams', cv2.WINDOW_NORMAL)
+
+        # Draw the constant labels and no-signal frames once instead of
+        # calling putText on every frame
+        labels = [render_label(f"Device #{i+1}", (0, 255, 0)) for i in range(len(receivers))]
+        blanks = []
+        for i in range(len(receivers)):
+            blank = np.zeros((WINDOW_HEIGHT, WINDOW_WIDTH, 3), np.uint8)
+            cv2.putText(blank, f"Device #{i+1} - No Signal", (10, 30),
+                      cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+            blanks.append(blank)
+
+        cv2.ocl.setUseOpenCL(USE_OPENCL)
+        if USE_OPENCL:
+            # Keep the constant images on the device; labels become
+            # full-frame overlays so they apply with one masked copy
+            ocl_labels = []
+            for pixels, mask in labels:
+                overlay = np.zeros((WINDOW_HEIGHT, WINDOW_WIDTH, 3), np.uint8)
+                overlay_mask = np.zeros((WINDOW_HEIGHT, WINDOW_WIDTH), np.uint8)
+                overlay[:pixels.shape[0], :pixels.shape[1]] = pixels
+                overlay_mask[:mask.shape[0], :mask.shape[1]] = mask
+                ocl_labels.append((cv2.UMat(overlay), cv2.UMat(overlay_mask)))
+            blanks = [cv2.UMat(blank) for blank in blanks]
         
         while True:
             # Get frames from both streams
             frames = [recv.get_frame() for recv in receivers]
-            if not any(frames):  # If no frames available yet
+            if all(frame is None for frame in frames):  # If no frames available yet
                 time.sleep(0.1)
                 continue
                 
@@ -152,23 +214,31 @@ def main(args):
             display_frames = []
             for i, frame in enumerate(frames):
                 if frame is not None:
-                    # Resize frame to target size
-                    resized = cv2.resize(frame, (WINDOW_WIDTH, WINDOW_HEIGHT))
-                    # Add device label
-                    label = f"Device #{i+1}"
-                    cv2.putText(resized, label, (10, 30), 
-                              cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                    needs_resize = frame.shape[:2] != (WINDOW_HEIGHT, WINDOW_WIDTH)
+                    if USE_OPENCL:
+                        # Upload once; everything after this runs on the device
+                        resized = cv2.UMat(frame)
+                        if needs_resize:
+                            resized = cv2.resize(resized, (WINDOW_WIDTH, WINDOW_HEIGHT))
+                        pixels, mask = ocl_labels[i]
+                        resized = cv2.copyTo(pixels, mask, resized)
+                    else:
+                        # Resize frame to target size unless it already matches
+                        if needs_resize:
+                            resized = cv2.resize(frame, (WINDOW_WIDTH, WINDOW_HEIGHT))
+                        else:
+                            resized = frame
+                        # Add device label
+                        pixels, mask = labels[i]
+                        roi = resized[:mask.shape[0], :mask.shape[1]]
+                        roi[mask] = pixels[mask]
                 else:
-                    # Create blank frame if stream not available
-                    blank = np.zeros((WINDOW_HEIGHT, WINDOW_WIDTH, 3), np.uint8)
-                    label = f"Device #{i+1} - No Signal"
-                    cv2.putText(blank, label, (10, 30),
-                              cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                    resized = blank
+                    # Use the blank frame if stream not available
+                    resized = blanks[i]
                 display_frames.append(resized)
             
-            # Combine frames side by side
-            display = np.hstack(display_frames)
+            # Combine frames side by side; imshow downloads a UMat itself
+            display = cv2.hconcat(display_frames)
             cv2.imshow('Voxel Streams', display)
             
             # Check for quit
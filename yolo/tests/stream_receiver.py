@@ -0,0 +1,322 @@
+"""
+Receiver for one Voxel MJPG stream, shared by the stream_both scripts.
+
+StreamReceiver listens on a local port for the device's framed JPEG stream
+(8-byte "VXL0" + length header, then the payload), decodes the newest frame
+and hands it to the display thread.
+"""
+
+import cv2
+import numpy as np
+import socket
+import struct
+import sys
+try:  # FIONREAD lets a receiver skip frames already superseded in the socket
+    import array
+    import fcntl
+    import termios
+except ImportError:  # Windows
+    fcntl = None
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+# SO_RCVTIMEO of 5 s: a DWORD of milliseconds on Windows, a struct timeval elsewhere
+if sys.platform == 'win32':
+    _RCVTIMEO_5S = struct.pack('I', 5000)
+else:
+    _RCVTIMEO_5S = struct.pack('ll', 5, 0)
+
+FRAME_WIDTH = 640  # Each stream
+FRAME_HEIGHT = 480
+MAX_FRAME_LEN = 5 * 1024 * 1024  # Largest JPEG payload accepted from a device
+MAX_PENDING_DECODES = 2  # Per stream; further frames are dropped while decoders are busy
+
+try:  # Optional libjpeg-turbo decoder (PyTurboJPEG); falls back to cv2.imdecode
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJFLAG_FASTDCT, TJFLAG_FASTUPSAMPLE
+except ImportError:
+    TurboJPEG = None
+
+
+def _load_turbojpeg():
+    """Return a TurboJPEG decoder, or None if PyTurboJPEG/libjpeg-turbo is unavailable."""
+    if TurboJPEG is None:
+        return None
+    try:
+        return TurboJPEG()
+    except Exception as e:
+        print(f"Warning: libjpeg-turbo not found, using cv2.imdecode: {e}")
+        return None
+
+
+# Optional nvJPEG decode on the GPU through torchvision; only imported when
+# a receiver asks for it (see _load_nvjpeg)
+torch = F = decode_jpeg = None
+
+
+def _load_nvjpeg() -> bool:
+    """Import torch/torchvision for nvJPEG decode; False if they or CUDA are unavailable."""
+    global torch, F, decode_jpeg
+    try:
+        import torch
+        import torch.nn.functional as F
+        from torchvision.io import decode_jpeg
+    except ImportError as e:
+        print(f"Warning: nvJPEG decode unavailable, using the CPU decoder: {e}")
+        return False
+    if not torch.cuda.is_available():
+        print("Warning: no CUDA device for nvJPEG decode, using the CPU decoder")
+        return False
+    return True
+
+
+class StreamReceiver:
+    """Handles receiving and decoding frames from one MJPG stream."""
+    
+    def __init__(self, port: int, gpu_decode: bool = False,
+                 new_frame_event: Optional[threading.Event] = None,
+                 decode_pool: Optional[ThreadPoolExecutor] = None):
+        self.port = port
+        # CPU decoding runs on this pool when given, otherwise on the receive thread
+        self.decode_pool = decode_pool
+        # Set whenever there is something new to display (a frame or a
+        # connection change); may be shared between receivers
+        self.new_frame_event = new_frame_event or threading.Event()
+        # With gpu_decode, frames are decoded by nvJPEG on the receive thread
+        # rather than the shared pool, and stay on the GPU until they are read
+        self.gpu_decode = gpu_decode and _load_nvjpeg()
+        # (frame, timestamp) of the latest frame. Replaced as a whole tuple, so
+        # a single attribute read/write hands it over atomically without a lock.
+        self._latest = (None, 0.0)
+        self.running = False
+        self.connected = False
+        self._jpeg = _load_turbojpeg()
+        self._scale_for = (None, None)  # ((width, height), scaling factor) cache
+        # Reused receive buffers; frames are read into them with recv_into.
+        # One payload buffer per pending decode plus one being received.
+        self._header_buf = bytearray(8)
+        self._recv_bufs = [bytearray(MAX_FRAME_LEN) for _ in range(MAX_PENDING_DECODES + 1)]
+        self._recv_idx = 0
+        self._decode_slots = threading.BoundedSemaphore(MAX_PENDING_DECODES)
+        self._publish_lock = threading.Lock()
+        self._frame_seq = 0
+        self._published_seq = 0
+        # Two preallocated frames: one published, one being resized into, so
+        # a published frame is never overwritten and readers need not copy it
+        self._frame_buffers = [np.empty((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8) for _ in range(2)]
+        self._back_idx = 0
+    
+    def _recv_exact(self, sock: socket.socket, length: int, buf: bytearray) -> Optional[memoryview]:
+        """Read exactly length bytes into buf and return a view of them, or None if connection closed."""
+        view = memoryview(buf)[:length]
+        pos = 0
+        while pos < length:
+            # MSG_WAITALL lets the kernel gather the whole read; the loop only
+            # repeats if it is cut short (e.g. by a signal)
+            n = sock.recv_into(view[pos:], length - pos, socket.MSG_WAITALL)
+            if not n:
+                return None
+            pos += n
+        return view
+
+    def _next_frame_buffered(self, sock: socket.socket) -> bool:
+        """Return True if a complete next frame is already queued in the socket (always False without fcntl)."""
+        if fcntl is None:
+            return False
+        pending = array.array('i', [0])
+        fcntl.ioctl(sock.fileno(), termios.FIONREAD, pending)
+        if pending[0] < 8:
+            return False
+        header = sock.recv(8, socket.MSG_PEEK)
+        if header[:4] != b"VXL0":
+            return False
+        return pending[0] >= 8 + struct.unpack(">I", header[4:])[0]
+
+    def _decode(self, jpeg_data: memoryview) -> Optional[np.ndarray]:
+        """Decode a JPEG frame to BGR, using libjpeg-turbo's SIMD decoder when available."""
+        if self._jpeg is None:
+            # np.frombuffer only wraps the receive buffer; nothing is copied
+            return cv2.imdecode(np.frombuffer(jpeg_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        try:
+            # The decoder reads the receive buffer's memoryview directly.
+            # Decode straight at a reduced size when the source is larger than
+            # the display, so the IDCT does the bulk of the downscale
+            width, height, _, _ = self._jpeg.decode_header(jpeg_data)
+            return self._jpeg.decode(jpeg_data, pixel_format=TJPF_BGR,
+                                     scaling_factor=self._scaling_factor(width, height),
+                                     flags=TJFLAG_FASTDCT | TJFLAG_FASTUPSAMPLE)
+        except (OSError, ValueError):
+            return None  # Corrupt frame; treated like a failed imdecode
+
+    def _scaling_factor(self, width: int, height: int) -> Optional[Tuple[int, int]]:
+        """Smallest libjpeg-turbo scale whose output still covers FRAME_WIDTH x FRAME_HEIGHT."""
+        if self._scale_for[0] != (width, height):
+            fits = [(num, denom) for num, denom in self._jpeg.scaling_factors
+                    if num <= denom
+                    and -(-width * num // denom) >= FRAME_WIDTH
+                    and -(-height * num // denom) >= FRAME_HEIGHT]
+            scale = min(fits, key=lambda f: f[0] / f[1], default=None)
+            self._scale_for = ((width, height), scale)
+        return self._scale_for[1]
+
+    def _decode_gpu(self, jpeg_data: memoryview):
+        """Decode and resize a JPEG frame on the GPU; returns an HxWx3 BGR CUDA tensor."""
+        try:
+            # Wrap the (writable) receive buffer in place instead of copying it
+            rgb = decode_jpeg(torch.frombuffer(jpeg_data, dtype=torch.uint8), device='cuda')
+        except RuntimeError:
+            return None  # Corrupt frame
+        if rgb.shape[1:] != (FRAME_HEIGHT, FRAME_WIDTH):
+            rgb = F.interpolate(rgb[None].float(), size=(FRAME_HEIGHT, FRAME_WIDTH),
+                                mode='bilinear', align_corners=False)[0].round_().to(torch.uint8)
+        return rgb.flip(0).permute(1, 2, 0).contiguous()
+
+    def _host_frame(self) -> Tuple[Optional[np.ndarray], float]:
+        """
+        The latest frame and its timestamp, on the host but possibly one of
+        the reused back buffers; only valid while the publish lock is held.
+        """
+        frame, ts = self._latest
+        if frame is not None and not isinstance(frame, np.ndarray):
+            # GPU-decoded frame: copy to host only now that it is displayed
+            frame = frame.cpu().numpy()
+        return frame, ts
+
+    def get_frame(self) -> Tuple[Optional[np.ndarray], float]:
+        """Get a copy of the latest frame and its timestamp. Thread-safe."""
+        with self._publish_lock:
+            frame, ts = self._host_frame()
+            if isinstance(self._latest[0], np.ndarray):
+                # A back buffer is overwritten two frames later; hand out a copy
+                frame = frame.copy()
+        return frame, ts
+
+    def copy_frame_into(self, dst: np.ndarray) -> bool:
+        """
+        Copy the latest frame into dst (FRAME_HEIGHT x FRAME_WIDTH); False if
+        there is none yet. Holds the publish lock, so a decoder cannot write
+        the buffer being copied.
+        """
+        with self._publish_lock:
+            frame, _ = self._host_frame()
+            if frame is None:
+                return False
+            np.copyto(dst, frame)
+            return True
+
+    def _update_frame(self, frame):
+        """Update the latest frame. Thread-safe."""
+        self._latest = (frame, time.time())
+        self.new_frame_event.set()
+
+    def _decode_and_update(self, jpeg_data: memoryview, seq: int):
+        """Decode one frame and publish it, unless a newer frame was published first."""
+        try:
+            frame = self._decode_gpu(jpeg_data) if self.gpu_decode else self._decode(jpeg_data)
+            if frame is None:
+                return
+            with self._publish_lock:
+                if seq < self._published_seq:
+                    return
+                self._published_seq = seq
+                if not self.gpu_decode and frame.shape[:2] != (FRAME_HEIGHT, FRAME_WIDTH):
+                    # Resize to target size into the back buffer, then publish it.
+                    # Frames already at the target size are published as decoded.
+                    back = self._frame_buffers[self._back_idx]
+                    cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT), dst=back)
+                    self._back_idx = 1 - self._back_idx
+                    frame = back
+                self._update_frame(frame)
+        finally:
+            self._decode_slots.release()
+
+    def receive_frames(self):
+        """Main receive loop - runs in its own thread."""
+        while self.running:
+            try:
+                # Try to connect/reconnect
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                # Large receive buffer (set before connect so the window scales)
+                # lets frame bursts queue in the kernel; no Nagle/delayed-ACK stalls
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if hasattr(socket, 'TCP_QUICKACK'):  # Linux only
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                sock.settimeout(5.0)  # Timeout for connect
+                sock.connect(('localhost', self.port))
+                # Switch to a blocking socket with a kernel-side receive timeout
+                # so MSG_WAITALL reads a whole frame in one syscall
+                sock.settimeout(None)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, _RCVTIMEO_5S)
+                self.connected = True
+                self.new_frame_event.set()
+                print(f"Connected to stream on port {self.port}")
+
+                while self.running:
+                    # Read 8-byte header
+                    header = self._recv_exact(sock, 8, self._header_buf)
+                    if not header:
+                        print(f"Stream {self.port}: Connection closed")
+                        break
+
+                    # Verify magic and get length
+                    if header[:4] != b"VXL0":
+                        print(f"Stream {self.port}: Invalid magic in header")
+                        break
+
+                    frame_len = struct.unpack(">I", header[4:])[0]
+                    if frame_len <= 0 or frame_len > MAX_FRAME_LEN:
+                        print(f"Stream {self.port}: Invalid frame length {frame_len}")
+                        break
+
+                    # Read and decode the JPEG frame
+                    jpeg_data = self._recv_exact(sock, frame_len, self._recv_bufs[self._recv_idx])
+                    if not jpeg_data:
+                        print(f"Stream {self.port}: Failed reading frame data")
+                        break
+
+                    # A newer frame is already fully buffered, so this one would
+                    # never be shown; skip decoding it
+                    if self._next_frame_buffered(sock):
+                        continue
+
+                    # Quick-reject corrupt payloads (no JPEG SOI/EOI markers)
+                    # before spending a decode on them
+                    if jpeg_data[:2] != b'\xff\xd8' or jpeg_data[-2:] != b'\xff\xd9':
+                        print(f"Stream {self.port}: Dropping corrupt frame")
+                        continue
+
+                    # Drop the frame if the decoders are still busy with earlier ones
+                    if not self._decode_slots.acquire(blocking=False):
+                        continue
+                    self._frame_seq += 1
+                    if self.decode_pool is None or self.gpu_decode:
+                        self._decode_and_update(jpeg_data, self._frame_seq)
+                    else:
+                        # The pending decode owns this buffer; receive into the next one
+                        self.decode_pool.submit(self._decode_and_update, jpeg_data, self._frame_seq)
+                        self._recv_idx = (self._recv_idx + 1) % len(self._recv_bufs)
+
+            except (socket.error, ConnectionError) as e:
+                print(f"Stream {self.port}: Connection error: {e}")
+                self.connected = False
+                self.new_frame_event.set()
+                if self.running:
+                    time.sleep(1.0)  # Wait before retry
+                continue
+
+            finally:
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+
+    def start(self):
+        """Start the receiver thread."""
+        self.running = True
+        threading.Thread(target=self.receive_frames, daemon=True).start()
+
+    def stop(self):
+        """Stop the receiver thread."""
+        self.running = False
@@ -3,16 +3,47 @@ Utilities for testing Voxel device streaming functionality.
 """
 
 import socket
+import struct
 import subprocess
+import sys
 import time
 from typing import Dict, List, Optional, Tuple
-from voxel_sdk import DeviceController
+from voxel_sdk.device_controller import DeviceController
 
-def get_network_info() -> Dict[str, Optional[str]]:
+try:  # Optional; reads the routing table directly instead of running netstat
+    import netifaces
+except ImportError:
+    netifaces = None
+
+WIFI_CONNECT_TIMEOUT = 3.0  # Max seconds to wait for the link after connecting
+WIFI_POLL_INTERVAL = 0.2  # Seconds between wifi_client_status polls
+STREAM_RETRY_DELAY = 0.05  # First pause between stream start attempts; doubles per failure
+STREAM_STOP_SETTLE = 0.5  # Pause after rdmp_stop so the device releases the old stream
+STREAM_RETRY_MAX_DELAY = 0.8
+
+# get_network_info() result, reused for _NET_INFO_TTL seconds
+_NET_INFO_CACHE = {'ts': 0.0, 'val': None}
+_NET_INFO_TTL = 30.0
+
+def _linux_gateway() -> Optional[str]:
+    """Read the default IPv4 gateway from /proc/net/route."""
+    with open('/proc/net/route') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 2 and fields[1] == '00000000':
+                return socket.inet_ntoa(struct.pack('<I', int(fields[2], 16)))
+    return None
+
+def get_network_info(force: bool = False) -> Dict[str, Optional[str]]:
     """
     Get network information including host IP and gateway.
-    Returns dict with 'host_ip' and 'gateway' keys.
+    Returns dict with 'host_ip' and 'gateway' keys. The result is cached for
+    _NET_INFO_TTL seconds; pass force=True to look it up again.
     """
+    if not force and _NET_INFO_CACHE['val'] is not None \
+            and time.monotonic() - _NET_INFO_CACHE['ts'] < _NET_INFO_TTL:
+        return dict(_NET_INFO_CACHE['val'])
+
     info = {'host_ip': None, 'gateway': None}
     
     try:
@@ -22,21 +53,45 @@ def get_network_info() -> Dict[str, Optional[str]]:
         info['host_ip'] = temp_sock.getsockname()[0]
         temp_sock.close()
         
-        # Get gateway on macOS
+        # Get gateway from netifaces, else from the routing table on Linux
+        # or netstat elsewhere (macOS)
         try:
-            result = subprocess.run(['netstat', '-nr'], capture_output=True, text=True)
-            for line in result.stdout.split('\n'):
-                if 'default' in line:
-                    parts = line.split()
-                    if len(parts) > 1:
-                        info['gateway'] = parts[1]
-                        break
+            if netifaces is not None:
+                info['gateway'] = netifaces.gateways().get('default', {}).get(netifaces.AF_INET, (None,))[0]
+            elif sys.platform.startswith('linux'):
+                info['gateway'] = _linux_gateway()
+            else:
+                result = subprocess.run(['netstat', '-nr'], capture_output=True, text=True)
+                for line in result.stdout.split('\n'):
+                    if line.startswith('default'):
+                        parts = line.split(None, 2)
+                        if len(parts) > 1:
+                            info['gateway'] = parts[1]
+                            break
         except Exception as e:
             print(f"Warning: Could not determine gateway: {e}")
     except Exception as e:
         print(f"Warning: Could not determine network info: {e}")
     
-    return info
+    _NET_INFO_CACHE['ts'] = time.monotonic()
+    _NET_INFO_CACHE['val'] = info
+    return dict(info)
+
+def wifi_on_network(status, ssid: str) -> bool:
+    """True if a wifi_client_status response shows the device on `ssid` with an IP."""
+    return isinstance(status, dict) and status.get('ssid') == ssid and bool(status.get('ip'))
+
+def wait_for_wifi(ctrl: DeviceController, ssid: str):
+    """
+    Poll wifi_client_status until the device is on `ssid` or
+    WIFI_CONNECT_TIMEOUT passes. Returns the last status response.
+    """
+    deadline = time.monotonic() + WIFI_CONNECT_TIMEOUT
+    while True:
+        status = ctrl.execute_device_command('wifi_client_status')
+        if wifi_on_network(status, ssid) or time.monotonic() >= deadline:
+            return status
+        time.sleep(WIFI_POLL_INTERVAL)
 
 def connect_devices() -> Optional[List[DeviceController]]:
     """
@@ -74,6 +129,15 @@ def setup_wifi(controllers: List[DeviceController], ssid: str, password: str) ->
         
         for i, ctrl in enumerate(controllers):
             print(f"\nConnecting device #{i+1} to WiFi...")
+
+            # Skip the disconnect/reconnect if the device is already on the network
+            try:
+                status = ctrl.execute_device_command('wifi_client_status')
+            except Exception:
+                status = None
+            if wifi_on_network(status, ssid):
+                print(f"Device #{i+1} already on {ssid} with IP {status.get('ip')}")
+                continue
             
             # First disconnect to clear any stale connections
             try:
@@ -99,10 +163,9 @@ def setup_wifi(controllers: List[DeviceController], ssid: str, password: str) ->
                         if host_parts[:2] != dev_parts[:2]:
                             print(f"Warning: Device #{i+1} ({dev_ip}) appears to be on different subnet than host ({net_info['host_ip']})")
             
-            time.sleep(3)  # Give WiFi more time to establish
-            
-            # Verify connection with status check
-            status = ctrl.execute_device_command('wifi_client_status')
+            # Verify connection, polling until the link is up rather than
+            # always sleeping for the worst case
+            status = wait_for_wifi(ctrl, ssid)
             print(f"WiFi status:", status)
             if isinstance(status, dict) and status.get('error'):
                 print(f"Device #{i+1} WiFi status check failed")
@@ -114,13 +177,16 @@ def setup_wifi(controllers: List[DeviceController], ssid: str, password: str) ->
         print(f"Error connecting to WiFi: {e}")
         return False
 
-def start_device_stream(ctrl: DeviceController, port: int, device_num: int) -> bool:
+def start_device_stream(ctrl: DeviceController, port: int, device_num: int,
+                        net_info: Optional[Dict[str, Optional[str]]] = None) -> bool:
     """
     Start MJPG stream on a single device with intelligent IP selection and retry.
+    Pass `net_info` to reuse one get_network_info() result across devices.
     Returns True if stream started successfully.
     """
     # Get potential target IPs
-    net_info = get_network_info()
+    if net_info is None:
+        net_info = get_network_info()
     ips_to_try = []
     if net_info['host_ip']:
         ips_to_try.append(net_info['host_ip'])
@@ -131,11 +197,13 @@ def start_device_stream(ctrl: DeviceController, port: int, device_num: int) -> b
     # Stop any existing stream
     try:
         ctrl.execute_device_command('rdmp_stop')
-        time.sleep(0.5)
+        time.sleep(STREAM_STOP_SETTLE)
     except Exception:
         pass
         
-    # Try each IP
+    # Try each IP, backing off exponentially so a quick success is not
+    # held up by a fixed pause
+    delay = STREAM_RETRY_DELAY
     for ip in ips_to_try:
         if not ip:
             print("Trying default IP (empty string)...")
@@ -160,7 +228,8 @@ def start_device_stream(ctrl: DeviceController, port: int, device_num: int) -> b
         except Exception as e:
             print(f"Error with IP {ip}: {e}")
         
-        time.sleep(0.5)  # Brief pause between attempts
+        time.sleep(delay)
+        delay = min(delay * 2, STREAM_RETRY_MAX_DELAY)
     
     print(f"Failed to start stream on device #{device_num+1}")
     return False
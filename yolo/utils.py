@@ -1,16 +1,198 @@
 # utils.py
+import os
+import selectors
 import socket
 import struct
+import time
+import cv2
+import numpy as np
 
-def _recv_exact(conn, length):
-    remaining = length
-    chunks = []
-    while remaining > 0:
-        chunk = conn.recv(remaining)
-        if not chunk: return b""
-        chunks.append(chunk)
-        remaining -= len(chunk)
-    return b"".join(chunks)
+try:  # FIONREAD lets the receivers see frames already queued in the socket
+    import array
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+
+try:  # Optional libjpeg-turbo decoder that outputs BGR directly (preferred)
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+try:  # Optional libjpeg-turbo decoder (PyTurboJPEG); falls back to cv2.imdecode
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except ImportError:
+    TurboJPEG = None
+
+
+def _load_turbojpeg():
+    """Return a TurboJPEG decoder, or None if PyTurboJPEG/libjpeg-turbo is unavailable."""
+    if TurboJPEG is None:
+        return None
+    try:
+        return TurboJPEG()
+    except Exception as e:
+        print(f"Warning: libjpeg-turbo not found, using cv2.imdecode: {e}")
+        return None
+
+
+_TJ = _load_turbojpeg()
+
+MAX_FRAME_LEN = 5 * 1024 * 1024  # Largest JPEG payload accepted from a device
+YOLO_IMGSZ = 640  # YOLO input size
+
+def _recv_exact(conn, length, buf=None):
+    # Read straight into one buffer instead of joining a list of chunks.
+    # Without `buf` a fresh bytearray is returned; with it (reused across
+    # calls, at least `length` long) a view of its first `length` bytes.
+    if buf is None:
+        buf = bytearray(length)
+        view = memoryview(buf)
+    else:
+        view = memoryview(buf)[:length]
+    off = 0
+    while off < length:
+        # MSG_WAITALL lets the kernel gather the whole read in one call; the
+        # loop only repeats if it is cut short (e.g. by a signal or timeout)
+        n = conn.recv_into(view[off:], length - off, socket.MSG_WAITALL)
+        if not n: return b""
+        off += n
+    return buf if len(view) == len(buf) else view
+
+def next_frame_buffered(conn):
+    """True if a complete next frame is already queued in the socket (always False without fcntl)."""
+    if fcntl is None:
+        return False
+    pending = array.array('i', [0])
+    fcntl.ioctl(conn.fileno(), termios.FIONREAD, pending)
+    if pending[0] < 8:
+        return False
+    header = conn.recv(8, socket.MSG_PEEK)
+    if header[:4] != b"VXL0":
+        return False
+    return pending[0] >= 8 + struct.unpack(">I", header[4:])[0]
+
+def _scale_factor(width, height, min_side):
+    """Largest libjpeg-turbo decode scale (1/8, 1/4, 1/2) keeping the long side >= min_side."""
+    long_side = max(width, height)
+    for factor in (8, 4, 2):
+        if long_side // factor >= min_side:
+            return factor
+    return 1
+
+def decode_jpeg(payload, min_side=0):
+    """
+    Decode a JPEG payload to a BGR frame; returns None if it cannot be decoded.
+    With `min_side`, libjpeg-turbo scales the image down while decoding, as far
+    as it can with the long side still at least `min_side` pixels. That saves
+    most of the decode, but only suits frames that are neither displayed nor
+    cropped at full resolution; the stream processors decode at full size.
+    """
+    if simplejpeg is not None:
+        try:
+            scale = {}
+            if min_side:
+                height, width = simplejpeg.decode_jpeg_header(payload)[:2]
+                factor = _scale_factor(width, height, min_side)
+                if factor > 1:  # Pin simplejpeg to exactly this factor
+                    scale = dict(min_factor=factor, min_width=width // factor, min_height=height // factor)
+            return simplejpeg.decode_jpeg(payload, colorspace='BGR', fastdct=True, fastupsample=True, **scale)
+        except ValueError:
+            pass  # Not something libjpeg-turbo can read; let OpenCV try
+    elif _TJ is not None:
+        try:
+            factor = 1
+            if min_side:
+                width, height = _TJ.decode_header(payload)[:2]
+                factor = _scale_factor(width, height, min_side)
+            return _TJ.decode(payload, pixel_format=TJPF_BGR, scaling_factor=(1, factor))
+        except (OSError, ValueError):
+            pass  # Not something libjpeg-turbo can read; let OpenCV try
+    return cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def prefer_engine(weights):
+    """Return the TensorRT engine exported next to `weights` (same name, .engine) if present, else `weights`."""
+    engine = os.path.splitext(weights)[0] + ".engine"
+    return engine if os.path.exists(engine) else weights
+
+def export_yolo_engine(weights, half=True, imgsz=YOLO_IMGSZ):
+    """
+    One-time export of YOLO `weights` to an FP16 TensorRT engine next to them
+    (needs a CUDA GPU with TensorRT). prefer_engine() picks it up on the next load.
+    """
+    from ultralytics import YOLO
+    return YOLO(weights).export(format='engine', half=half, imgsz=imgsz, dynamic=False, workspace=4)
+
+def accept_stream(listener, timeout, stop=None):
+    """
+    Waits up to `timeout` seconds for a connection on `listener` and returns
+    (conn, addr), or None as soon as `stop` (a threading.Event) is set.
+    Raises TimeoutError if nothing connects in time.
+    """
+    listener.setblocking(False)
+    deadline = time.monotonic() + timeout
+    with selectors.DefaultSelector() as sel:
+        sel.register(listener, selectors.EVENT_READ)
+        while stop is None or not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Timed out waiting for stream connection from device")
+            # Wake periodically to check `stop`
+            if not sel.select(min(remaining, 0.2)):
+                continue
+            try:
+                conn, addr = listener.accept()
+            except BlockingIOError:
+                continue  # The connection went away before we took it
+            conn.setblocking(True)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return conn, addr
+    return None
+
+def _busiest_rx_core(cores):
+    """
+    Returns the core in `cores` that has processed the most incoming packets
+    (per /proc/net/softnet_stat), i.e. the one taking the NIC's receive
+    interrupts, or None if that cannot be read.
+    """
+    counts = {}
+    try:
+        with open("/proc/net/softnet_stat") as f:
+            for row, line in enumerate(f):
+                fields = line.split()
+                # Newer kernels append the CPU id as the 13th column
+                cpu = int(fields[12], 16) if len(fields) > 12 else row
+                counts[cpu] = int(fields[0], 16)
+    except (OSError, ValueError, IndexError):
+        return None
+    allowed = [c for c in cores if counts.get(c)]
+    return max(allowed, key=counts.get) if allowed else None
+
+def split_cores():
+    """
+    Returns (receiver_cores, inference_cores): one allowed core for the
+    receiver and the rest for inference, or (None, None) if affinity
+    cannot be set here. The receiver gets the core already handling network
+    receive interrupts, so socket data stays in that core's cache.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None, None
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < 2:
+        return None, None
+    rx_core = _busiest_rx_core(cores)
+    if rx_core is None:
+        rx_core = cores[0]
+    return {rx_core}, set(cores) - {rx_core}
+
+def pin_current_thread(cores):
+    """Pins the calling thread to `cores` (Linux only; no-op when None)."""
+    if cores is None:
+        return
+    try:
+        os.sched_setaffinity(0, cores)
+    except OSError as e:
+        print(f"Warning: Could not set CPU affinity: {e}")
 
 def get_local_ip():
     try:
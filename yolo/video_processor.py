@@ -1,23 +1,47 @@
 # video_processor.py
 import cv2
+import logging
+import os
+import queue
+import threading
 import time
 import struct
 import socket
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import torch
 from ultralytics import YOLO
 from voxel_sdk.device_controller import DeviceController
 from voxel_sdk.ble import BleVoxelTransport
 
 # Import from our other project files
 import shared_state
-from utils import _recv_exact, get_local_ip
+from utils import (MAX_FRAME_LEN, YOLO_IMGSZ, _recv_exact, accept_stream, decode_jpeg, get_local_ip,
+                   next_frame_buffered, pin_current_thread, prefer_engine, split_cores)
 import classifier
 
-def setup_stream_connection(device_name="voxel", stream_port=9000):
+log = logging.getLogger(__name__)
+
+STREAM_RCVBUF = 1 << 20  # Receive buffer for the stream socket
+BOX_COLOR = (0, 255, 0)
+
+# Run YOLO in FP16 on CUDA (Tensor Cores, half the memory traffic); the CPU
+# path stays FP32
+YOLO_HALF = torch.cuda.is_available()
+
+# Reused for every frame header and payload; each payload is decoded
+# before the next one is read
+_HDR_BUF = bytearray(8)
+_PAYLOAD_BUF = bytearray(MAX_FRAME_LEN)
+_MAGIC = struct.unpack(">I", b"VXL0")[0]
+
+def _connect_device(device_name, cores=None):
     """
-    Connects to the Voxel device and sets up the TCP listener.
-    Returns the transport, filesystem, and the connection socket from the device.
+    Connects to the Voxel device over BLE and returns (transport, fs). Run off
+    the processing thread, pinned to `cores`, so the BLE transport's own
+    threads start there rather than on the inference cores.
     """
+    pin_current_thread(cores)
     print("Helper: Connecting to Voxel device...")
     transport = BleVoxelTransport(device_name=device_name)
     transport.connect("")
@@ -26,65 +50,182 @@ def setup_stream_connection(device_name="voxel", stream_port=9000):
     # transport is already connected; expose the controller filesystem helper
     fs = controller.filesystem
     print("Helper: Connected.")
+    return transport, fs
 
-    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    listener.bind(("0.0.0.0", stream_port))
-    listener.listen(1)
-    print(f"Helper: TCP server listening for video on port {stream_port}...")
 
-    my_ip = get_local_ip()
-    print(f"Helper: My local IP is {my_ip}. Telling device to connect...")
-    response = fs.start_rdmp_stream(my_ip, stream_port)
-    if "error" in response:
-        raise RuntimeError(f"Device failed to start streaming: {response}")
+def setup_stream_connection(device_name="voxel", stream_port=9000, stop=None, while_connecting=None,
+                            ble_cores=None):
+    """
+    Connects to the Voxel device and sets up the TCP listener. The BLE
+    connection is made on a helper thread (pinned to `ble_cores`) while this
+    one sets up the listener and runs `while_connecting`, if given.
+    Returns the transport, filesystem, and the connection socket from the device;
+    the socket is None if `stop` was set while waiting for it.
+    """
+    pool = ThreadPoolExecutor(max_workers=1)
+    connecting = pool.submit(_connect_device, device_name, ble_cores)
+    pool.shutdown(wait=False)
 
-    listener.settimeout(20.0)
+    listener = None
     try:
-        conn, addr = listener.accept()
-        print(f"Helper: Stream connection received from device: {addr}")
-        return transport, fs, conn
-    except socket.timeout:
-        raise TimeoutError("Timed out waiting for stream connection from device")
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Set before accept so the connection inherits it and the TCP window
+        # is negotiated for it: a whole frame fits in the kernel buffer
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, STREAM_RCVBUF)
+        listener.bind(("0.0.0.0", stream_port))
+        listener.listen(1)
+        print(f"Helper: TCP server listening for video on port {stream_port}...")
+
+        if while_connecting is not None:
+            while_connecting()
+        transport, fs = connecting.result()
+
+        my_ip = get_local_ip()
+        print(f"Helper: My local IP is {my_ip}. Telling device to connect...")
+        response = fs.start_rdmp_stream(my_ip, stream_port)
+        if "error" in response:
+            raise RuntimeError(f"Device failed to start streaming: {response}")
+
+        accepted = accept_stream(listener, 20.0, stop)
+    except BaseException:
+        # The caller never sees the transport, so release it here; wait for
+        # the helper thread if it is still connecting
+        try:
+            transport = connecting.result()[0]
+        except Exception:
+            transport = None
+        if transport is not None and transport.is_connected():
+            try: transport.disconnect()
+            except Exception as ex: print(f"Warning: transport.disconnect() failed: {ex}")
+        raise
     finally:
-        listener.close()
+        if listener is not None:
+            listener.close()
+
+    if accepted is None:
+        return transport, fs, None
+    conn, addr = accepted
+    print(f"Helper: Stream connection received from device: {addr}")
+    return transport, fs, conn
 
 
 def receive_frame(conn):
     """
     Receives a single frame payload from the socket and decodes it.
+    Frames the processor has fallen behind on (a newer one is already
+    queued in the socket) are read but not decoded.
     Returns the OpenCV frame or None if the stream ends.
     """
-    print("Receiving frame header...")
-    header = _recv_exact(conn, 8)
-    if not header:
-        print("No header received")
-        return None
-    if header[:4] != b"VXL0":
-        print(f"Invalid header magic: {header[:4]}")
-        return None
-    
-    frame_len = struct.unpack(">I", header[4:])[0]
-    print(f"Expecting frame payload of {frame_len} bytes")
-    payload = _recv_exact(conn, frame_len)
-    if not payload:
-        print("No payload received")
-        return None
+    while True:
+        log.debug("Receiving frame header...")
+        header = _recv_exact(conn, 8, _HDR_BUF)
+        if not header:
+            print("No header received")
+            return None
+        # Magic and length in one unpack, comparing the magic as an integer
+        magic, frame_len = struct.unpack_from(">II", header)
+        if magic != _MAGIC:
+            print(f"Invalid header magic: {bytes(header[:4])}")
+            return None
+        
+        if frame_len <= 0 or frame_len > MAX_FRAME_LEN:
+            print(f"Invalid frame length: {frame_len}")
+            return None
+        
+        log.debug("Expecting frame payload of %d bytes", frame_len)
+        payload = _recv_exact(conn, frame_len, _PAYLOAD_BUF)
+        if not payload:
+            print("No payload received")
+            return None
+
+        if not next_frame_buffered(conn):
+            break
+        log.debug("Skipping stale frame; a newer one is already buffered")
     
-    frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+    # Decode at full size: the frame is displayed (and cropped for
+    # classification); only the YOLO input is downsized
+    frame = decode_jpeg(payload)
     if frame is None:
         print("Failed to decode frame")
         return None
     
-    print(f"Successfully decoded frame: {frame.shape}")
+    log.debug("Successfully decoded frame: %s", frame.shape)
     return frame
 
 
-def video_processing_thread(mode, model=None, device_name="voxel", stream_port=9000):
+def _box_rows(result):
+    """
+    Returns the result's boxes as (x1, y1, x2, y2, conf, cls) rows with int
+    coordinates and class ids, converted as whole arrays after one
+    device-to-host transfer.
+    """
+    data = result.boxes.data.cpu().numpy()
+    xyxy = data[:, :4].astype(np.int32).tolist()
+    confs = data[:, 4].tolist()
+    clss = data[:, 5].astype(np.int32).tolist()
+    return [(*box, conf, cls) for box, conf, cls in zip(xyxy, confs, clss)]
+
+
+def _draw_boxes(frame, boxes, names):
+    """Draws _box_rows() rows onto `frame` in place."""
+    for x1, y1, x2, y2, conf, cls in boxes:
+        cv2.rectangle(frame, (x1, y1), (x2, y2), BOX_COLOR, 2)
+        cv2.putText(frame, f"{names[cls]} {conf:.2f}", (x1, max(y1 - 10, 10)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, BOX_COLOR, 2)
+
+
+def _render_hud(status, car_label):
+    """Renders the status text once; returns its pixels and a mask of the drawn text."""
+    pixels = np.zeros((95, 900, 3), np.uint8)
+    cv2.putText(pixels, f"Mode: {status}", (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 255, 0), 2)
+    if car_label:
+        cv2.putText(pixels, f"Car: {car_label}", (10, 80), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 255, 0), 2)
+    return pixels, pixels.any(axis=2)
+
+
+def _warm_up(model):
+    """Runs one prediction on a blank frame so model and CUDA setup are done before the first real frame."""
+    try:
+        model.predict(np.zeros((YOLO_IMGSZ, YOLO_IMGSZ, 3), np.uint8), half=YOLO_HALF, verbose=False)
+        print("Helper: Model warmed up.")
+    except Exception as e:
+        print(f"Warning: Model warm-up failed: {e}")
+
+
+def _receive_loop(conn, frames, stop, cores=None):
+    """
+    Receives and decodes frames into the size-1 `frames` queue, replacing any
+    frame the processor has not taken yet. Puts None when the stream ends.
+    """
+    pin_current_thread(cores)
+    try:
+        while not stop.is_set():
+            frame = receive_frame(conn)
+            if frame is None:
+                break
+            try:
+                frames.get_nowait()  # Drop the stale frame
+            except queue.Empty:
+                pass
+            frames.put(frame)
+    except Exception as e:
+        if not stop.is_set():
+            print(f"Receiver: Stream error: {e}")
+    finally:
+        try:
+            frames.get_nowait()
+        except queue.Empty:
+            pass
+        frames.put(None)
+
+
+def video_processing_thread(mode, model=None, device_name="voxel", stream_port=9000, stop=None):
     """
     Orchestrator for video processing with a two-stage state machine:
     1. CLASSIFYING_CAR: Uses a general model to find and classify a car.
     2. DETECTING_DENTS: Switches to a specialized model for dent detection.
+    Runs until the stream ends or `stop` (a threading.Event) is set.
     """
     # --- State Machine and Model Setup ---
     current_mode = "CLASSIFYING_CAR"
@@ -94,85 +235,118 @@ def video_processing_thread(mode, model=None, device_name="voxel", stream_port=9
     DENT_MODEL_PATH = 'yolo11m_car_damage.pt' # A sensible default
 
     transport, fs, conn = None, None, None
+    if stop is None:
+        stop = threading.Event()
+    # Status overlay, re-rendered only when its text changes
+    hud_key, hud = None, None
+
+    # Keep inference off the receiver's core so the models' worker threads
+    # do not preempt the latency-sensitive network reader
+    receiver_cores, inference_cores = split_cores()
+    inference_threads = len(inference_cores) if inference_cores else max(1, (os.cpu_count() or 2) - 1)
+    torch.set_num_threads(inference_threads)
+    cv2.setNumThreads(inference_threads)
+    pin_current_thread(inference_cores)
     
     try:
-        transport, fs, conn = setup_stream_connection(device_name, stream_port)
+        # Warm up the car model while the BLE connection (often several
+        # seconds) is made on a helper thread sharing the receiver's core
+        transport, fs, conn = setup_stream_connection(device_name, stream_port, stop,
+                                                      while_connecting=lambda: _warm_up(car_detection_model),
+                                                      ble_cores=receiver_cores)
+        if conn is None:
+            print("Background thread: Stopped before the stream connected."); return
+
+        # Receive and decode on a separate thread so the next frame is ready
+        # while the models run on this one
+        frames = queue.Queue(maxsize=1)
+        threading.Thread(target=_receive_loop, args=(conn, frames, stop, receiver_cores), daemon=True).start()
         
-        while True:
-            frame = receive_frame(conn)
+        while not stop.is_set():
+            try:
+                frame = frames.get(timeout=1.0)
+            except queue.Empty:
+                continue
             if frame is None:
                 print("Background thread: Stream ended."); break
 
-            annotated_frame = frame.copy()
+            # Boxes are drawn straight onto the decoded frame; it is new for
+            # every frame and not published until the end of this pass
+            boxes, names = [], None
+            # detection_data changes for this frame, published together with
+            # the frame in one critical section at the end of the pass
+            updates = {}
+            if shared_state.detection_data['status'] != current_mode:
+                updates['status'] = current_mode
 
             # --- MAIN STATE MACHINE LOGIC ---
             if current_mode == "CLASSIFYING_CAR":
-                with shared_state.lock:
-                    shared_state.detection_data['status'] = 'CLASSIFYING_CAR'
-                
-                results = car_detection_model.predict(frame, conf=0.5, verbose=False)
-                annotated_frame = results[0].plot()
-
-                # Find the first confident 'car' detection
-                for box in results[0].boxes:
-                    class_name = results[0].names[int(box.cls[0])]
-                    if class_name == 'car' and box.conf[0] > 0.75:
-                        print("Processor: Car detected. Cropping and classifying...")
-                        x1, y1, x2, y2 = map(int, box.xyxy[0])
-                        car_crop = frame[y1:y2, x1:x2]
+                results = car_detection_model.predict(frame, conf=0.5, half=YOLO_HALF, verbose=False)
+                names = results[0].names
+                boxes = _box_rows(results[0])
 
+                # Collect every confident 'car' detection in this frame
+                car_crops = []
+                for x1, y1, x2, y2, conf, cls in boxes:
+                    if names[cls] == 'car' and conf > 0.75:
+                        car_crop = frame[y1:y2, x1:x2]
                         if car_crop.size > 0:
-                            label, confidence = classifier.classify_image(car_crop)
-                            print(f"Processor: Classification result: {label} ({confidence:.1f}%)")
-
-                            # --- STATE TRANSITION ---
-                            with shared_state.lock:
-                                shared_state.detection_data['car_classification']['label'] = label
-                                shared_state.detection_data['car_classification']['confidence'] = confidence
-                            
-                            print("Processor: --- Switching to DENT DETECTION mode ---")
-                            current_mode = "DETECTING_DENTS"
-                            if dent_detection_model is None:
-                                print(f"Processor: Loading dent detection model from '{DENT_MODEL_PATH}'...")
-                                dent_detection_model = YOLO(DENT_MODEL_PATH)
-                            break # Stop processing other cars in this frame
+                            car_crops.append(car_crop)
 
-            elif current_mode == "DETECTING_DENTS":
-                with shared_state.lock:
-                    shared_state.detection_data['status'] = 'DETECTING_DENTS'
+                if car_crops:
+                    print(f"Processor: {len(car_crops)} car(s) detected. Classifying crops in one batch...")
+                    # Keep the most confident classification among the crops
+                    label, confidence = max(classifier.classify_images(car_crops), key=lambda result: result[1])
+                    print(f"Processor: Classification result: {label} ({confidence:.1f}%)")
 
-                results = dent_detection_model.predict(frame, conf=0.4, iou=0.3, verbose=False)
-                annotated_frame = results[0].plot()
+                    # --- STATE TRANSITION ---
+                    updates['car_classification'] = {"label": label, "confidence": confidence}
+
+                    print("Processor: --- Switching to DENT DETECTION mode ---")
+                    current_mode = "DETECTING_DENTS"
+                    if dent_detection_model is None:
+                        print(f"Processor: Loading dent detection model from '{DENT_MODEL_PATH}'...")
+                        dent_detection_model = YOLO(prefer_engine(DENT_MODEL_PATH))
+
+            elif current_mode == "DETECTING_DENTS":
+                results = dent_detection_model.predict(frame, conf=0.4, iou=0.3, half=YOLO_HALF, verbose=False)
+                names = results[0].names
+                boxes = _box_rows(results[0])
 
                 dent_list = []
-                for box in results[0].boxes:
+                for *xyxy, conf, cls in boxes:
                     dent_list.append({
-                        "box": [int(coord) for coord in box.xyxy[0]],
-                        "confidence": float(box.conf[0]),
-                        "class_name": results[0].names[int(box.cls[0])]
+                        "box": xyxy,
+                        "confidence": conf,
+                        "class_name": names[cls]
                     })
-                with shared_state.lock:
-                    shared_state.detection_data['dent_detections'] = dent_list
+                updates['dent_detections'] = dent_list
             
-            # --- Update display frame with status text ---
-            with shared_state.lock:
-                status_text = f"Mode: {shared_state.detection_data['status']}"
-                car_text = f"Car: {shared_state.detection_data['car_classification']['label']}"
-            cv2.putText(annotated_frame, status_text, (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 255, 0), 2)
-            if shared_state.detection_data['car_classification']['label']:
-                 cv2.putText(annotated_frame, car_text, (10, 80), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 255, 0), 2)
+            # --- Annotate boxes and status text ---
+            # (the crops above have been classified, so drawing cannot leak into them)
+            _draw_boxes(frame, boxes, names)
+            snapshot = {**shared_state.detection_data, **updates}
+            key = (snapshot['status'], snapshot['car_classification']['label'])
+            if key != hud_key:
+                hud_key, hud = key, _render_hud(*key)
+            pixels, mask = hud
+            h, w = min(mask.shape[0], frame.shape[0]), min(mask.shape[1], frame.shape[1])
+            roi, mask = frame[:h, :w], mask[:h, :w]
+            roi[mask] = pixels[:h, :w][mask]
 
             # --- Update shared state with the final annotated frame ---
-            with shared_state.lock:
-                shared_state.latest_annotated_frame = np.ascontiguousarray(annotated_frame)
+            # The frame is new every pass and nothing draws on it after this
+            # point, so it is published by reference swap; any copy needed
+            # for contiguity happens before taking the lock
+            shared_state.publish_frame(np.ascontiguousarray(frame), **updates)
 
     except Exception as e:
         print(f"An error occurred in the background thread: {e}")
-        with shared_state.lock:
-            shared_state.detection_data = {"status": "error", "message": str(e)}
+        shared_state.publish_detections(status="error", message=str(e))
     finally:
         # (This finally block remains the same as you provided it)
         print("Background thread: Cleaning up...")
+        stop.set()
         if conn: conn.close()
         if fs: fs.stop_rdmp_stream()
         if transport and transport.is_connected():
@@ -1,6 +1,47 @@
 # shared_state.py
+import json
+import logging
 import threading
 import time
+import cv2
+import numpy as np
+
+try:  # Optional faster JSON encoder for the API payload
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # Optional libjpeg-turbo encoder for the frame snapshot
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+log = logging.getLogger(__name__)
+
+JPEG_QUALITY = 70  # Quality of the /frame.jpg snapshot
+
+
+def _encode(data):
+    """Encodes detection data to JSON bytes for the API."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=_to_builtin).encode('utf-8')
+
+
+def _encode_jpeg(frame):
+    """Encodes a BGR frame to JPEG bytes for the API."""
+    if simplejpeg is not None:
+        return simplejpeg.encode_jpeg(frame, quality=JPEG_QUALITY, colorspace='BGR')
+    ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buf.tobytes() if ok else b''
+
+
+def _to_builtin(obj):
+    """json.dumps fallback for numpy arrays and scalars."""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
 
 # This dictionary holds all our application's data.
 detection_data = {
@@ -8,24 +49,94 @@ detection_data = {
     "summary": {},
     "detections": {} 
 }
+# Cached JSON encoding of detection_data; built lazily by get_detection_json().
+detection_json = None
+# Bumped on every update; served as the /detections ETag.
+detection_version = 0
 
-# This holds the latest frame for the live GUI feed.
-latest_annotated_frame = None
+# The lock to ensure thread-safe access to the variables below.
+lock = threading.Lock()
+
+# Size (width, height) of the frames handed to the live GUI feed.
+DISPLAY_SIZE = (1280, 720)
+
+# This holds the latest frame for the live GUI feed. update_frame() publishes
+# a new array for every frame and never writes to one after publishing it,
+# so readers can use latest_annotated_frame directly instead of copying it.
+latest_annotated_frame = np.zeros((DISPLAY_SIZE[1], DISPLAY_SIZE[0], 3), dtype=np.uint8)
+# The JPEG bytes latest_annotated_frame was decoded from, before annotation;
+# served as-is by /frame.jpg?annotated=0 (see get_raw_jpeg()).
+latest_raw_jpeg = None
+# Cached JPEG encoding of latest_annotated_frame; built lazily by get_frame_jpeg().
+latest_annotated_jpeg = None
+# Bumped on every published frame; served as the /frame.jpg ETag.
+frame_version = 0
 last_frame_update_time = None
+# Set by update_frame() whenever a new frame is published, so the display
+# can wait for one instead of polling.
+frame_updated = threading.Event()
 
-# The lock to ensure thread-safe access to the above variables.
-lock = threading.Lock()
+def set_detection_data(data):
+    """Thread-safe function to publish new detection data"""
+    global detection_data, detection_json, detection_version
+    with lock:
+        detection_data, detection_json = data, None
+        detection_version += 1
 
-def update_frame(frame):
-    """Thread-safe function to update the latest frame"""
-    global latest_annotated_frame, last_frame_update_time
+def get_detection_json():
+    """Thread-safe function to get (detection_version, JSON bytes), encoded at most once per update"""
+    global detection_json
     with lock:
-        try:
-            if frame is not None and frame.size > 0:
-                latest_annotated_frame = frame.copy()
-                last_frame_update_time = time.time()
-                print(f"State: Frame updated successfully, shape: {frame.shape}")
+        data, body, version = detection_data, detection_json, detection_version
+    if body is None:
+        body = _encode(data)
+        with lock:
+            if detection_data is data:
+                detection_json = body
+    return version, body
+
+def get_frame_jpeg():
+    """Thread-safe function to get (frame_version, JPEG bytes) of the latest frame, encoded at most once per frame"""
+    global latest_annotated_jpeg
+    with lock:
+        frame, body, version = latest_annotated_frame, latest_annotated_jpeg, frame_version
+    if body is None:
+        body = _encode_jpeg(frame)
+        with lock:
+            # Skip caching if a newer frame was published while encoding
+            if frame_version == version:
+                latest_annotated_jpeg = body
+    return version, body
+
+def get_raw_jpeg():
+    """Thread-safe function to get (frame_version, source JPEG bytes or None) of the latest frame"""
+    with lock:
+        return frame_version, latest_raw_jpeg
+
+def update_frame(frame, raw_jpeg=None):
+    """
+    Thread-safe function to update the latest frame and, optionally, its source JPEG.
+    A frame already at DISPLAY_SIZE is published as-is, so the caller must not
+    write to it afterwards.
+    """
+    global latest_annotated_frame, latest_raw_jpeg, latest_annotated_jpeg, frame_version, last_frame_update_time
+    try:
+        if frame is not None and frame.size > 0:
+            # Never write into the published array: a reader may still be
+            # showing or encoding the previous one outside the lock
+            if frame.shape[:2] != (DISPLAY_SIZE[1], DISPLAY_SIZE[0]):
+                published = cv2.resize(frame, DISPLAY_SIZE)
             else:
-                print("State: Warning - Received invalid frame")
-        except Exception as e:
-            print(f"State: Error updating frame: {e}")
\ No newline at end of file
+                published = frame
+            with lock:
+                latest_annotated_frame = published
+                latest_raw_jpeg = raw_jpeg
+                latest_annotated_jpeg = None
+                frame_version += 1
+                last_frame_update_time = time.time()
+            frame_updated.set()
+            log.debug("State: Frame updated successfully, shape: %s", frame.shape)
+        else:
+            print("State: Warning - Received invalid frame")
+    except Exception as e:
+        print(f"State: Error updating frame: {e}")
\ No newline at end of file
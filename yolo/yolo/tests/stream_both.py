@@ -24,6 +24,7 @@ STREAM_PORTS = [9000, 9001]  # Left and right stream ports
 WINDOW_NAME = "Voxel Streams"
 FRAME_WIDTH = 640  # Each stream
 FRAME_HEIGHT = 480
+MAX_FRAME_LEN = 5 * 1024 * 1024  # Largest JPEG payload accepted from a device
 
 class StreamReceiver:
     """Handles receiving and decoding frames from one MJPG stream."""
@@ -35,18 +36,21 @@ class StreamReceiver:
         self.running = False
         self.connected = False
         self._lock = threading.Lock()
+        # Receive buffers reused for every frame; each payload is decoded
+        # before the next one is read
+        self._header_buf = bytearray(8)
+        self._payload_buf = bytearray(MAX_FRAME_LEN)
     
-    def _recv_exact(self, sock: socket.socket, length: int) -> Optional[bytes]:
-        """Read exactly length bytes or return None if connection closed."""
-        chunks = []
-        remaining = length
-        while remaining > 0:
-            chunk = sock.recv(remaining)
-            if not chunk:
+    def _recv_exact(self, sock: socket.socket, length: int, buf: bytearray) -> Optional[memoryview]:
+        """Read exactly length bytes into buf and return a view of them, or None if connection closed."""
+        view = memoryview(buf)[:length]
+        pos = 0
+        while pos < length:
+            n = sock.recv_into(view[pos:], length - pos, socket.MSG_WAITALL)
+            if not n:
                 return None
-            chunks.append(chunk)
-            remaining -= len(chunk)
-        return b"".join(chunks)
+            pos += n
+        return view
 
     def get_frame(self) -> Tuple[Optional[np.ndarray], float]:
         """Get the latest frame and its timestamp. Thread-safe."""
@@ -72,7 +76,7 @@ class StreamReceiver:
 
                 while self.running:
                     # Read 8-byte header
-                    header = self._recv_exact(sock, 8)
+                    header = self._recv_exact(sock, 8, self._header_buf)
                     if not header:
                         print(f"Stream {self.port}: Connection closed")
                         break
@@ -83,16 +87,17 @@ class StreamReceiver:
                         break
 
                     frame_len = struct.unpack(">I", header[4:])[0]
-                    if frame_len <= 0 or frame_len > 5 * 1024 * 1024:
+                    if frame_len <= 0 or frame_len > MAX_FRAME_LEN:
                         print(f"Stream {self.port}: Invalid frame length {frame_len}")
                         break
 
                     # Read and decode the JPEG frame
-                    jpeg_data = self._recv_exact(sock, frame_len)
+                    jpeg_data = self._recv_exact(sock, frame_len, self._payload_buf)
                     if not jpeg_data:
                         print(f"Stream {self.port}: Failed reading frame data")
                         break
 
+                    # Wraps the receive buffer without copying it
                     frame_array = np.frombuffer(jpeg_data, dtype=np.uint8)
                     frame = cv2.imdecode(frame_array, cv2.IMREAD_COLOR)
                     if frame is not None:
@@ -133,35 +138,32 @@ def main():
         r.start()
 
     try:
-        blank = np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+        # One side-by-side canvas reused for every displayed frame; each
+        # stream is copied (and labeled) straight into its half
+        canvas = np.zeros((FRAME_HEIGHT, FRAME_WIDTH * len(receivers), 3), dtype=np.uint8)
+        halves = [canvas[:, i * FRAME_WIDTH:(i + 1) * FRAME_WIDTH] for i in range(len(receivers))]
         while True:
-            # Get latest frames
-            frames = []
             for i, receiver in enumerate(receivers):
                 frame, ts = receiver.get_frame()
+                half = halves[i]
                 if frame is None:
                     # If no frame, show info text on blank
-                    info = blank.copy()
+                    half[:] = 0
                     text = f"Waiting for stream {STREAM_PORTS[i]}..."
                     if receiver.connected:
                         text += " (Connected)"
-                    cv2.putText(info, text,
+                    cv2.putText(half, text,
                               (40, FRAME_HEIGHT//2),
                               cv2.FONT_HERSHEY_SIMPLEX, 0.8,
                               (255, 255, 255), 2)
-                    frames.append(info)
                 else:
                     # Add port number to frame
-                    labeled = frame.copy()
-                    cv2.putText(labeled, f"Port {STREAM_PORTS[i]}",
+                    np.copyto(half, frame)
+                    cv2.putText(half, f"Port {STREAM_PORTS[i]}",
                               (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
                               0.8, (0, 255, 0), 2)
-                    frames.append(labeled)
 
-            # Combine side by side
-            if len(frames) == 2:
-                display = np.hstack(frames)
-                cv2.imshow(WINDOW_NAME, display)
+            cv2.imshow(WINDOW_NAME, canvas)
             
             # Check for quit
             key = cv2.waitKey(1)
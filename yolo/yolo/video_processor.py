@@ -1,25 +1,118 @@
 # # In video_processor.py
 
+import atexit
 import cv2
 import base64
+import logging
+import os
+import queue
+import threading
 import time
 import struct
 import socket
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from collections import defaultdict
+import torch
 from voxel_sdk.device_controller import DeviceController
 from voxel_sdk.ble import BleVoxelTransport
 
 # Import from our other project files
 import shared_state
-from utils import _recv_exact, get_local_ip
+from utils import (MAX_FRAME_LEN, YOLO_IMGSZ, _recv_exact, accept_stream, decode_jpeg, get_local_ip,
+                   next_frame_buffered, pin_current_thread, split_cores)
 
+log = logging.getLogger(__name__)
 
-def setup_stream_connection(device_name="voxel", stream_port=9000):
+STREAM_RCVBUF = 1 << 20  # Receive buffer for the stream socket
+
+# Run YOLO in FP16 on CUDA (Tensor Cores, half the memory traffic); the CPU
+# path stays FP32
+YOLO_HALF = torch.cuda.is_available()
+
+# Reused for every frame header and payload; each payload is decoded (and
+# copied out if it is published) before the next one is read
+_HDR_BUF = bytearray(8)
+_PAYLOAD_BUF = bytearray(MAX_FRAME_LEN)
+_MAGIC = struct.unpack(">I", b"VXL0")[0]
+
+# Letterboxed YOLO input for the CUDA path, allocated once per frame size
+# (see _yolo_input): a pinned host buffer to resize into and device tensors
+# it is uploaded to and normalized in
+_YOLO_INPUT = {"shape": None}
+
+# Box label masks keyed by label text ("class: 0.87"), so recurring labels
+# are rasterized once instead of on every frame
+_LABEL_CACHE = {}
+_LABEL_CACHE_MAX = 1024
+_LABEL_PAD = 2  # Room for the stroke around the glyphs
+
+# Device connection and TCP listener kept across stream restarts, so a
+# restart only re-issues the stream command. Released at interpreter exit.
+_session = {"transport": None, "fs": None, "listener": None, "port": None}
+
+
+def _disconnect(transport):
+    """Disconnects `transport`, logging rather than raising on failure."""
+    try:
+        transport.disconnect()
+    except RuntimeError as re:
+        # Some Ble implementations try to join the running loop thread from
+        # inside the same thread which raises RuntimeError("cannot join current thread").
+        # Ignore this in cleanup and log it.
+        print(f"Warning: transport.disconnect() raised RuntimeError during cleanup: {re}")
+    except Exception as ex:
+        print(f"Warning: transport.disconnect() failed during cleanup: {ex}")
+
+
+def _close_session():
+    """Closes the pooled listener and disconnects the pooled device."""
+    if _session["listener"] is not None:
+        _session["listener"].close()
+    transport = _session["transport"]
+    if transport and transport.is_connected():
+        _disconnect(transport)
+    _session.update(transport=None, fs=None, listener=None, port=None)
+
+
+atexit.register(_close_session)
+
+
+def _yolo_input(frame):
     """
-    Connects to the Voxel device and sets up the TCP listener.
-    Returns the transport, filesystem, and the connection socket from the device.
+    Letterboxes `frame` into the reused CUDA input tensor and returns
+    (tensor, scale); predicted boxes divided by `scale` are in frame pixels.
+    predict() runs a BCHW float tensor in [0, 1] as-is, without its own
+    letterbox, normalize or upload, so this is the only per-frame input.
     """
+    buf = _YOLO_INPUT
+    h, w = frame.shape[:2]
+    if buf["shape"] != (h, w):
+        scale = YOLO_IMGSZ / max(h, w)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        host = torch.empty((size[1], size[0], 3), dtype=torch.uint8).pin_memory()
+        buf.update(
+            shape=(h, w), scale=scale, size=size, host=host, host_np=host.numpy(),
+            # Padding stays at YOLO's gray; only the image area is rewritten
+            dev=torch.full((YOLO_IMGSZ, YOLO_IMGSZ, 3), 114, dtype=torch.uint8, device="cuda"),
+            input=torch.empty((1, 3, YOLO_IMGSZ, YOLO_IMGSZ), dtype=torch.float16, device="cuda"),
+        )
+    w_in, h_in = buf["size"]
+    cv2.resize(frame, buf["size"], dst=buf["host_np"])
+    # The upload overlaps with the rest of this call; predict() syncs before
+    # the host buffer is written again
+    buf["dev"][:h_in, :w_in].copy_(buf["host"], non_blocking=True)
+    # BGR HWC uint8 -> RGB CHW float16 in [0, 1]
+    buf["input"][0].copy_(buf["dev"].permute(2, 0, 1).flip(0)).div_(255)
+    return buf["input"], buf["scale"]
+
+
+def _connect_device(device_name, cores=None):
+    """
+    Connects to the Voxel device over BLE and returns (transport, fs). Run off
+    the processing thread, pinned to `cores`, so the BLE transport's own
+    threads start there rather than on the inference cores.
+    """
+    pin_current_thread(cores)
     print("Helper: Connecting to Voxel device...")
     transport = BleVoxelTransport(device_name=device_name)
     transport.connect("")
@@ -28,180 +121,317 @@ def setup_stream_connection(device_name="voxel", stream_port=9000):
     # transport is already connected; expose the controller filesystem helper
     fs = controller.filesystem
     print("Helper: Connected.")
+    return transport, fs
+
+
+def setup_stream_connection(device_name="voxel", stream_port=9000, stop=None,
+                            while_connecting=None, ble_cores=None):
+    """
+    Connects to the Voxel device and sets up the TCP listener, reusing both
+    from an earlier call when they are still usable. `while_connecting`, if
+    given, runs on this thread in either case; a new BLE connection is made
+    meanwhile on a helper thread pinned to `ble_cores`.
+    Returns the transport, filesystem, and the connection socket from the device;
+    the socket is None if `stop` was set while waiting for it.
+    """
+    transport, fs = _session["transport"], _session["fs"]
+    connecting = None
+    if transport is not None and transport.is_connected():
+        print("Helper: Reusing connected Voxel device.")
+        try:
+            fs.stop_rdmp_stream()  # Clear any stream left from the last session
+        except Exception:
+            pass
+    else:
+        if transport is not None:
+            # The pooled link dropped; release its handle before replacing it
+            print("Helper: Pooled Voxel device disconnected; reconnecting.")
+            _disconnect(transport)
+            _session.update(transport=None, fs=None)
+        pool = ThreadPoolExecutor(max_workers=1)
+        connecting = pool.submit(_connect_device, device_name, ble_cores)
+        pool.shutdown(wait=False)
 
-    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    listener.bind(("0.0.0.0", stream_port))
-    listener.listen(1)
+    listener = _session["listener"]
+    if listener is None or _session["port"] != stream_port:
+        if listener is not None:
+            listener.close()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Set before accept so the connection inherits it and the TCP window
+        # is negotiated for it: a whole frame fits in the kernel buffer
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, STREAM_RCVBUF)
+        listener.bind(("0.0.0.0", stream_port))
+        listener.listen(1)
+        _session.update(listener=listener, port=stream_port)
     print(f"Helper: TCP server listening for video on port {stream_port}...")
 
+    if while_connecting is not None:
+        while_connecting()
+    if connecting is not None:
+        transport, fs = connecting.result()
+        _session.update(transport=transport, fs=fs)
+
     my_ip = get_local_ip()
     print(f"Helper: My local IP is {my_ip}. Telling device to connect...")
     response = fs.start_rdmp_stream(my_ip, stream_port)
     if "error" in response:
         raise RuntimeError(f"Device failed to start streaming: {response}")
 
-    listener.settimeout(20.0)
-    try:
-        conn, addr = listener.accept()
-        print(f"Helper: Stream connection received from device: {addr}")
-        return transport, fs, conn
-    except socket.timeout:
-        raise TimeoutError("Timed out waiting for stream connection from device")
-    finally:
-        listener.close()
+    accepted = accept_stream(listener, 20.0, stop)
+    if accepted is None:
+        return transport, fs, None
+    conn, addr = accepted
+    print(f"Helper: Stream connection received from device: {addr}")
+    return transport, fs, conn
 
 
 def receive_frame(conn):
     """
     Receives a single frame payload from the socket and decodes it.
-    Returns the OpenCV frame or None if the stream ends.
+    Frames the processor has fallen behind on (a newer one is already
+    queued in the socket) are read but not decoded.
+    Returns (OpenCV frame, JPEG payload) or None if the stream ends.
     """
-    print("Receiving frame header...")
-    header = _recv_exact(conn, 8)
-    if not header:
-        print("No header received")
-        return None
-    if header[:4] != b"VXL0":
-        print(f"Invalid header magic: {header[:4]}")
-        return None
-    
-    frame_len = struct.unpack(">I", header[4:])[0]
-    print(f"Expecting frame payload of {frame_len} bytes")
-    payload = _recv_exact(conn, frame_len)
-    if not payload:
-        print("No payload received")
-        return None
+    while True:
+        log.debug("Receiving frame header...")
+        header = _recv_exact(conn, 8, _HDR_BUF)
+        if not header:
+            print("No header received")
+            return None
+        # Magic and length in one unpack, comparing the magic as an integer
+        magic, frame_len = struct.unpack_from(">II", header)
+        if magic != _MAGIC:
+            print(f"Invalid header magic: {bytes(header[:4])}")
+            return None
+        
+        if frame_len <= 0 or frame_len > MAX_FRAME_LEN:
+            print(f"Invalid frame length: {frame_len}")
+            return None
+        
+        log.debug("Expecting frame payload of %d bytes", frame_len)
+        payload = _recv_exact(conn, frame_len, _PAYLOAD_BUF)
+        if not payload:
+            print("No payload received")
+            return None
+
+        if not next_frame_buffered(conn):
+            break
+        log.debug("Skipping stale frame; a newer one is already buffered")
     
-    frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+    # Decode at full size for the display; only the YOLO input is downsized
+    frame = decode_jpeg(payload)
     if frame is None:
         print("Failed to decode frame")
         return None
     
-    print(f"Successfully decoded frame: {frame.shape}")
-    return frame
+    log.debug("Successfully decoded frame: %s", frame.shape)
+    # The payload buffer is refilled by the next read; publish a copy
+    return frame, bytes(payload)
+
+
+def _label_mask(text):
+    """Returns (mask, baseline_y) for a box label, rendering it on first use."""
+    cached = _LABEL_CACHE.get(text)
+    if cached is None:
+        (w, h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2)
+        canvas = np.zeros((h + baseline + 2 * _LABEL_PAD, w + 2 * _LABEL_PAD), np.uint8)
+        cv2.putText(canvas, text, (_LABEL_PAD, _LABEL_PAD + h), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 255, 2)
+        if len(_LABEL_CACHE) >= _LABEL_CACHE_MAX:
+            _LABEL_CACHE.clear()
+        cached = _LABEL_CACHE[text] = (canvas.astype(bool), _LABEL_PAD + h)
+    return cached
+
+
+def _draw_label(frame, text, org, color):
+    """Draws a cached label like cv2.putText at `org`, clipped to the frame."""
+    mask, baseline_y = _label_mask(text)
+    top, left = org[1] - baseline_y, org[0] - _LABEL_PAD
+    t0, l0 = max(top, 0), max(left, 0)
+    t1 = min(top + mask.shape[0], frame.shape[0])
+    l1 = min(left + mask.shape[1], frame.shape[1])
+    if t0 < t1 and l0 < l1:
+        frame[t0:t1, l0:l1][mask[t0-top:t1-top, l0-left:l1-left]] = color
 
 
-def process_frame_and_update_state(frame, mode, model=None):
+def process_frame_and_update_state(frame, mode, model=None, raw_jpeg=None):
     """
     Processes a single frame using local YOLO model and updates the shared global state.
+    `raw_jpeg` is the JPEG the frame was decoded from, published alongside it.
     """
     # no module-level globals here; we update shared_state directly
-    print(f"Processing frame shape: {frame.shape if frame is not None else 'None'}")
+    log.debug("Processing frame shape: %s", frame.shape if frame is not None else None)
 
     try:
         # Process with local YOLO model
         t0 = time.time()
-        print("Local: Running YOLO detection...")
-        results = model.predict(frame, conf=0.4, iou=0.3, verbose=False)
+        log.debug("Local: Running YOLO detection...")
+        if YOLO_HALF:
+            # Reuse one device input instead of letting predict() allocate
+            # and upload a new one for every frame
+            source, scale = _yolo_input(frame)
+        else:
+            source, scale = frame, 1.0
+        results = model.predict(source, conf=0.4, iou=0.3, half=YOLO_HALF, verbose=False)
         result = results[0]
         dt = time.time() - t0
-        print(f"Local: Detection completed in {dt*1000:.0f}ms")
+        log.debug("Local: Detection completed in %.0fms", dt * 1000)
 
-        # Get detections and annotate frame
+        # Get detections and annotate the frame in place; it was decoded for
+        # this call alone and is handed to update_frame() afterwards
         boxes = result.boxes
-        annotated_frame = frame.copy()
+        annotated_frame = frame
         
-        detections_summary = defaultdict(lambda: {"count": 0, "total_conf": 0.0})
+        final_summary = {}
         
         if boxes is not None and len(boxes) > 0:
-            for box in boxes:
-                # Get box coordinates and convert to int
-                x1, y1, x2, y2 = [int(val) for val in box.xyxy[0]]
-                conf = float(box.conf[0])
-                cls = int(box.cls[0])
-                class_name = result.names[cls]
-                
+            # Pull every field off the device in one transfer; boxes.data
+            # holds x1, y1, x2, y2, conf, cls per row
+            data = boxes.data.cpu().numpy()
+            xyxy = (data[:, :4] / scale).astype(np.int32)
+            confs = data[:, 4]
+            clss = data[:, 5].astype(np.int32)
+
+            color = (0, 255, 0)
+            for (x1, y1, x2, y2), conf, cls in zip(xyxy.tolist(), confs.tolist(), clss.tolist()):
                 # Draw box and label
-                color = (0, 255, 0)
                 cv2.rectangle(annotated_frame, (x1, y1), (x2, y2), color, 2)
-                label = f"{class_name}: {conf:.2f}"
-                cv2.putText(annotated_frame, label, (x1, y1-10), 
-                          cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-                
-                # Update detection summary
-                detections_summary[class_name]["count"] += 1
-                detections_summary[class_name]["total_conf"] += conf
-
-        # Calculate average confidence for each class
-        final_summary = {}
-        for cls, stats in detections_summary.items():
-            final_summary[cls] = {
-                "count": stats["count"],
-                "average_confidence": stats["total_conf"] / stats["count"]
-            }
+                label = f"{result.names[cls]}: {conf:.2f}"
+                _draw_label(annotated_frame, label, (x1, y1-10), color)
+
+            # Count and average confidence for each class in one pass
+            counts = np.bincount(clss)
+            conf_sums = np.bincount(clss, weights=confs)
+            for cls in np.flatnonzero(counts).tolist():
+                final_summary[result.names[cls]] = {
+                    "count": int(counts[cls]),
+                    "average_confidence": float(conf_sums[cls] / counts[cls])
+                }
 
         # Update shared state
-        print("Local: Updating shared state...")
+        log.debug("Local: Updating shared state...")
         num_boxes = len(boxes) if boxes is not None else 0
-        with shared_state.lock:
-            shared_state.latest_annotated_frame = np.ascontiguousarray(annotated_frame)
-            shared_state.detection_data = {"status": "success", "detections": final_summary}
-            print(f"Local: Frame processed and updated, found {num_boxes} objects")
+        shared_state.update_frame(annotated_frame, raw_jpeg)
+        shared_state.set_detection_data({"status": "success", "detections": final_summary})
+        log.debug("Local: Frame processed and updated, found %d objects", num_boxes)
 
     except Exception as e:
         print(f"Error processing frame: {e}")
-        with shared_state.lock:
-            shared_state.detection_data = {"status": "error", "message": str(e)}
+        shared_state.set_detection_data({"status": "error", "message": str(e)})
+
+
+
+def _warm_up(model):
+    """Runs one prediction on a blank frame so model and CUDA setup are done before the first real frame."""
+    if model is None:
+        return
+    try:
+        blank = np.zeros((YOLO_IMGSZ, YOLO_IMGSZ, 3), np.uint8)
+        source = _yolo_input(blank)[0] if YOLO_HALF else blank
+        model.predict(source, half=YOLO_HALF, verbose=False)
+        print("Helper: Model warmed up.")
+    except Exception as e:
+        print(f"Warning: Model warm-up failed: {e}")
 
 
+def _receive_loop(conn, frames, stop, cores=None):
+    """
+    Receives frames into the size-1 `frames` queue, replacing any frame the
+    processor has not taken yet. Puts None when the stream ends.
+    """
+    pin_current_thread(cores)
+    try:
+        while not stop.is_set():
+            received = receive_frame(conn)
+            if received is None:
+                break
+            try:
+                frames.get_nowait()  # Drop the stale frame
+            except queue.Empty:
+                pass
+            frames.put(received)
+    except Exception as e:
+        if not stop.is_set():
+            print(f"Receiver: Stream error: {e}")
+    finally:
+        try:
+            frames.get_nowait()
+        except queue.Empty:
+            pass
+        frames.put(None)
 
 
-def video_processing_thread(mode, model=None, device_name="voxel", stream_port=9000):
+def video_processing_thread(mode, model=None, device_name="voxel", stream_port=9000, stop=None):
     """
     High-level orchestrator for video processing using local YOLO model.
+    Runs until the stream ends or `stop` (a threading.Event) is set.
     """
     # video_processing_thread will update shared_state; no local globals needed
     transport, fs, conn = None, None, None
+    if stop is None:
+        stop = threading.Event()
     frame_count = 0
     last_fps_print = time.time()
     
     # Initialize display frame
-    with shared_state.lock:
-        shared_state.latest_annotated_frame = np.zeros((720, 1280, 3), dtype=np.uint8)
-        cv2.putText(shared_state.latest_annotated_frame, "Starting up...", (480, 360), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    startup_frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+    cv2.putText(startup_frame, "Starting up...", (480, 360), 
+               cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    shared_state.update_frame(startup_frame)
+
+    # Keep inference off the receiver's core so the model's worker threads
+    # do not preempt the latency-sensitive network reader
+    receiver_cores, inference_cores = split_cores()
+    inference_threads = len(inference_cores) if inference_cores else max(1, (os.cpu_count() or 2) - 1)
+    torch.set_num_threads(inference_threads)
+    cv2.setNumThreads(inference_threads)
+    pin_current_thread(inference_cores)
 
     try:
-        transport, fs, conn = setup_stream_connection(device_name, stream_port)
-        while True:
+        # Warm up the model while the BLE connection (often several seconds)
+        # is made on a helper thread sharing the receiver's core
+        transport, fs, conn = setup_stream_connection(device_name, stream_port, stop,
+                                                      while_connecting=lambda: _warm_up(model),
+                                                      ble_cores=receiver_cores)
+        if conn is None:
+            print("Background thread: Stopped before the stream connected."); return
+
+        # Receive on a separate thread so the next frame is read and decoded
+        # while this one is being processed
+        frames = queue.Queue(maxsize=1)
+        threading.Thread(target=_receive_loop, args=(conn, frames, stop, receiver_cores), daemon=True).start()
+
+        while not stop.is_set():
             t0 = time.time()
-            frame = receive_frame(conn)
+            try:
+                received = frames.get(timeout=1.0)
+            except queue.Empty:
+                continue
             t_recv = time.time()
-            if frame is None:
+            if received is None:
                 print("Background thread: Stream ended."); break
             
-            process_frame_and_update_state(frame, mode, model=model)
+            frame, raw_jpeg = received
+            process_frame_and_update_state(frame, mode, model=model, raw_jpeg=raw_jpeg)
             t_done = time.time()
 
             frame_count += 1
             if t_done - last_fps_print >= 5.0:
                 fps = frame_count / (t_done - last_fps_print)
-                print(f"FPS: {fps:.1f} (recv: {(t_recv-t0)*1000:.0f}ms, proc: {(t_done-t_recv)*1000:.0f}ms)")
+                print(f"FPS: {fps:.1f} (wait: {(t_recv-t0)*1000:.0f}ms, proc: {(t_done-t_recv)*1000:.0f}ms)")
                 frame_count = 0
                 last_fps_print = t_done
 
-            # Brief sleep to prevent CPU overload
-            time.sleep(0.001)
-
     except Exception as e:
         print(f"An error occurred in the background thread: {e}")
-        with shared_state.lock:
-            shared_state.detection_data = {"status": "error", "message": str(e), "detections": {}}
+        shared_state.set_detection_data({"status": "error", "message": str(e), "detections": {}})
     finally:
         print("Background thread: Cleaning up...")
+        stop.set()
         if conn:
             conn.close()
         if fs:
             fs.stop_rdmp_stream()
-        if transport and transport.is_connected():
-            try:
-                transport.disconnect()
-            except RuntimeError as re:
-                # Some Ble implementations try to join the running loop thread from
-                # inside the same thread which raises RuntimeError("cannot join current thread").
-                # Ignore this in cleanup and log it.
-                print(f"Warning: transport.disconnect() raised RuntimeError during cleanup: {re}")
-            except Exception as ex:
-                print(f"Warning: transport.disconnect() failed during cleanup: {ex}")
-        print("Background thread: Disconnected and shut down.")
+        # The device connection and listener stay open for the next
+        # setup_stream_connection(); _close_session() releases them at exit
+        print("Background thread: Stream stopped and shut down.")